@@ -0,0 +1,97 @@
+import threading
+from collections import Counter
+from concurrent.futures import Future
+
+from panda3d.core import Filename, PNMImage
+from panda3d.core import Shader, Texture
+
+from heightfield import texture_channel
+from rawheightfield import RawHeightfield, EXTENSION
+
+
+class Heightfield:
+    """A heightmap decoded only once. The image is used by BulletHeightfieldShape
+       and GeoMipTerrain, the texture by shaders, and the arrays by the queries.
+       raw is the RawHeightfield which the image was read from, if any.
+    """
+
+    def __init__(self, img, raw=None):
+        self.img = img
+        self.raw = raw
+        self.texture = Texture()
+        self.texture.load(img)
+        self.heights = texture_channel(self.texture)
+        self.alpha = texture_channel(self.texture, 'A') if img.has_alpha() else None
+
+    @property
+    def size(self):
+        return self.img.get_size()
+
+
+class AssetCache:
+    """Load heightmaps, textures and shaders once and share them between objects."""
+
+    def __init__(self):
+        # the futures of the assets, which are set when loaded.
+        self.assets = {}
+        self.hits = Counter()
+        self.misses = Counter()
+        # the scene objects and the terrain tiles are built on worker threads.
+        self.lock = threading.Lock()
+
+    def get(self, kind, key, load):
+        """Return the asset, loading it on the first request. Different assets are loaded
+           in parallel; the other threads requesting an asset being loaded wait for it.
+        """
+        with self.lock:
+            if (future := self.assets.get((kind, key))) is not None:
+                self.hits[kind] += 1
+                loader = False
+            else:
+                self.misses[kind] += 1
+                future = self.assets[(kind, key)] = Future()
+                loader = True
+
+        if not loader:
+            return future.result()
+
+        try:
+            future.set_result(load())
+        except BaseException as e:
+            # forget the failure, so that the asset can be requested again.
+            with self.lock:
+                del self.assets[(kind, key)]
+            future.set_exception(e)
+
+        return future.result()
+
+    def heightfield(self, path):
+        if path.endswith(EXTENSION):
+            def load():
+                raw = RawHeightfield(path)
+                return Heightfield(raw.image(), raw)
+
+            return self.get('heightfield', path, load)
+
+        return self.get('heightfield', path, lambda: Heightfield(PNMImage(Filename(path))))
+
+    def texture(self, path):
+        return self.get('texture', path, lambda: base.loader.load_texture(path))
+
+    def shader(self, vert_path, frag_path):
+        return self.get(
+            'shader', (vert_path, frag_path),
+            lambda: Shader.load(Shader.SL_GLSL, vert_path, frag_path)
+        )
+
+    def report(self):
+        kinds = sorted(set(self.hits) | set(self.misses))
+        return {kind: {'hits': self.hits[kind], 'misses': self.misses[kind]} for kind in kinds}
+
+    def clear(self):
+        self.assets.clear()
+        self.hits.clear()
+        self.misses.clear()
+
+
+asset_cache = AssetCache()
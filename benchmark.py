@@ -0,0 +1,218 @@
+"""Replay a scripted input trace headlessly and report frame timings as JSON.
+
+   >python benchmark.py --output bench.json
+   >python benchmark.py --window-type offscreen
+   >python benchmark.py --crowd 500
+   >python benchmark.py --scene scenes/tiled.json
+"""
+import argparse
+import json
+import sys
+import time
+from collections import Counter, defaultdict
+
+from direct.showbase.ShowBaseGlobal import globalClock
+from panda3d.core import load_prc_file_data
+from panda3d.core import ClockObject, Point3, BitMask32
+
+from assets import asset_cache
+from instrumentation import instruments
+from terrain_with_hole import TerrainWithHole
+from walker import Motions, Status
+
+
+# Each phase places the walker on the first ground below (x, y, z) with the heading,
+# and then holds the keys for the number of frames.
+TRACE = [
+    ['surface', (-18.0243, 14.9644, 0), 180, [
+        (60, [Motions.FORWARD]),
+        (30, [Motions.FORWARD, Motions.LEFT]),
+        (60, [Motions.FORWARD]),
+        (30, [Motions.RIGHT]),
+        (60, [Motions.BACKWARD]),
+    ]],
+    ['square_tunnel', (5.6, -18.0, 0), 231, [
+        (150, [Motions.FORWARD]),
+    ]],
+    ['passage', (-19.05, 20.6, 0), 0, [
+        (30, [Motions.FORWARD]),
+        (180, []),
+        (60, [Motions.FORWARD]),
+    ]],
+    ['basement', (-38.1466, -18.5, -40), 0, [
+        (60, [Motions.FORWARD]),
+        (120, []),
+        (90, [Motions.FORWARD]),
+    ]],
+]
+
+
+class CountingWorld:
+    """Wrap BulletWorld to count the queries and time do_physics."""
+
+    QUERIES = ('ray_test_closest', 'ray_test_all', 'sweep_test_closest', 'contact_test', 'contact_test_pair')
+
+    def __init__(self, world, profiler, counts=None):
+        self.world = world
+        self.profiler = profiler
+        self.counts = Counter() if counts is None else counts
+
+    def __getattr__(self, name):
+        attr = getattr(self.world, name)
+
+        if name in self.QUERIES:
+            def query(*args, **kwargs):
+                self.counts[name] += 1
+                return attr(*args, **kwargs)
+            return query
+
+        if name == 'do_physics':
+            return self.profiler.timed('do_physics', attr)
+
+        return attr
+
+
+class Profiler:
+
+    def __init__(self):
+        self.times = defaultdict(list)
+
+    def timed(self, name, func):
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            result = func(*args, **kwargs)
+            self.times[name].append(time.perf_counter() - start)
+            return result
+        return wrapper
+
+    def summary(self):
+        return {
+            name: {
+                'calls': len(times),
+                'total_ms': sum(times) * 1000,
+                'mean_ms': sum(times) / len(times) * 1000,
+                'max_ms': max(times) * 1000,
+            } for name, times in self.times.items() if times
+        }
+
+    def reset(self):
+        self.times.clear()
+
+
+class Benchmark(TerrainWithHole):
+
+    def __init__(self, frame_rate=60, crowd=0, scene='scenes/default.json', workers=0):
+        # all the models are built beforehand, so that the phases are not slowed down by loading.
+        super().__init__(crowd=crowd, lazy=False, workers=workers, scene=scene)
+        self.key_inputs = []
+        self.profiler = Profiler()
+        self.world = CountingWorld(self.world, self.profiler)
+
+        # the queries to the worlds of the zones are counted together.
+        layers = self.scene.layers
+        layers.worlds = {zone: CountingWorld(world, self.profiler, self.world.counts)
+                         for zone, world in layers.worlds.items()}
+
+        # Every frame advances by the same dt, regardless of the real time.
+        globalClock.set_mode(ClockObject.M_non_real_time)
+        globalClock.set_frame_rate(frame_rate)
+
+        self.control_walker = self.profiler.timed('walker_update', self.control_walker)
+        self.control_camera = self.profiler.timed('camera_control', self.control_camera)
+        water = self.scene.mid_water
+        water.wave = self.profiler.timed('water_wave', water.wave)
+
+    def get_key_inputs(self):
+        return self.key_inputs
+
+    def place_walker(self, pos, heading):
+        self.scene.load_streams(Point3(*pos))
+
+        if hit := self.scene.cast_down(Point3(*pos), BitMask32.bit(1), -100):
+            self.walker.set_pos(hit.get_hit_pos() + Point3(0, 0, 1.5))
+
+        self.walker.direction_nd.set_h(heading)
+        self.walker.status = Status.MOVE
+        self.walker.responded_sensor = None
+        self.walker.zone = self.scene.zone_below(self.walker.get_pos())
+        self.camera.set_pos(self.walker.get_pos() + self.cam_distance)
+        self.reset_interpolation()
+
+    def run_phase(self, steps):
+        frames = 0
+        start = time.perf_counter()
+
+        for n, keys in steps:
+            self.key_inputs = keys
+
+            for _ in range(n):
+                self.taskMgr.step()
+                frames += 1
+
+        return frames, time.perf_counter() - start
+
+    def run(self, trace=TRACE):
+        results = {}
+
+        for name, pos, heading, steps in trace:
+            self.place_walker(pos, heading)
+            self.profiler.reset()
+            self.world.counts.clear()
+            self.scene.queries.reset_counts()
+            instruments.reset()
+            frames, elapsed = self.run_phase(steps)
+
+            results[name] = {
+                'frames': frames,
+                'frame_ms': elapsed / frames * 1000,
+                'timings': self.profiler.summary(),
+                'queries': dict(self.world.counts),
+                'query_categories': self.scene.queries.report(),
+                'instruments': instruments.summary(),
+                'walker_pos': list(self.walker.get_pos()),
+                'walker_status': self.walker.status.name,
+            }
+
+            if self.crowd is not None:
+                results[name]['crowd'] = self.crowd.counts()
+
+        return {
+            'dt': globalClock.get_dt(),
+            'phases': results,
+            'assets': asset_cache.report(),
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the update loop of TerrainWithHole.')
+    parser.add_argument('--output', '-o', help='file to write the JSON result; stdout by default.')
+    parser.add_argument('--window-type', default='none', choices=['none', 'offscreen'])
+    parser.add_argument('--frame-rate', type=int, default=60)
+    parser.add_argument('--crowd', type=int, default=0, help='number of NPC walkers.')
+    parser.add_argument('--scene', default='scenes/default.json', help='scene description file.')
+    parser.add_argument('--workers', type=int, default=0, help='number of threads to build the scene on.')
+    parser.add_argument('--instruments', help='file to dump the per-frame counters and timers, .csv or .json.')
+    args = parser.parse_args()
+
+    load_prc_file_data('', f"""
+        window-type {args.window_type}
+        audio-library-name null
+        sync-video false""")
+
+    instruments.enable(args.instruments, dump_interval=0)
+    benchmark = Benchmark(args.frame_rate, args.crowd, args.scene, args.workers)
+    result = benchmark.run()
+
+    if args.instruments:
+        instruments.dump(args.instruments)
+    text = json.dumps(result, indent=2)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text)
+    else:
+        sys.stdout.write(text + '\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,178 @@
+import math
+
+import numpy as np
+from panda3d.core import Point3, Vec3, Quat
+
+
+class OcclusionMap:
+    """Coarse grid of the lowest terrain surface in each cell, used to find
+       camera positions that are surely buried in the terrain without ray tests.
+       Cells with holes have no lowest surface, because tunnels can pass through them.
+       For a terrain read from a raw heightfield, the cells are its blocks and
+       their lowest heights are taken from its min/max pyramid.
+    """
+
+    def __init__(self, terrain, cell_size=4):
+        self.terrain = terrain
+        if (raw := terrain.heightfield.raw) is not None:
+            cell_size = raw.block_size
+
+        self.cell_size = cell_size
+        rows, cols = terrain.heights.shape
+
+        if raw is None:
+            heights = terrain.heights * terrain.height - terrain.height / 2
+
+        self.origin = base.render.get_relative_point(terrain, Point3(-(cols - 1) / 2, -(rows - 1) / 2, 0))
+        cells_y = math.ceil((rows - 1) / cell_size)
+        cells_x = math.ceil((cols - 1) / cell_size)
+        self.min_z = np.full((cells_y, cells_x), -np.inf, dtype=np.float32)
+
+        for cy in range(cells_y):
+            for cx in range(cells_x):
+                i0, j0 = cx * cell_size, cy * cell_size
+                i1, j1 = min(i0 + cell_size, cols - 1), min(j0 + cell_size, rows - 1)
+
+                if terrain.removed[j0:j1, i0:i1].any():
+                    continue
+
+                if raw is None:
+                    low = heights[j0:j1 + 1, i0:i1 + 1].min()
+                else:
+                    low = raw.height_range(i0, j0, i1, j1)[0] * terrain.height - terrain.height / 2
+
+                self.min_z[cy, cx] = low + self.origin.z
+
+        self.top = float(self.min_z.max())
+
+    def may_cover(self, start, end):
+        """Return False if the segment between the points is surely above the terrain,
+           which is found only from the cells in the bounding box of the segment.
+        """
+        if min(start.z, end.z) >= self.top:
+            return False
+
+        cells_y, cells_x = self.min_z.shape
+        x0, x1 = sorted((start.x, end.x))
+        y0, y1 = sorted((start.y, end.y))
+        cx0 = max(math.floor((x0 - self.origin.x) / self.cell_size), 0)
+        cx1 = min(math.floor((x1 - self.origin.x) / self.cell_size), cells_x - 1)
+        cy0 = max(math.floor((y0 - self.origin.y) / self.cell_size), 0)
+        cy1 = min(math.floor((y1 - self.origin.y) / self.cell_size), cells_y - 1)
+
+        if cx0 > cx1 or cy0 > cy1:
+            return False
+
+        return min(start.z, end.z) < self.min_z[cy0:cy1 + 1, cx0:cx1 + 1].max()
+
+    def below(self, points):
+        """Return True if any of the points, an array of shape (n, 3) in world coordinates,
+           is under the surface of the terrain.
+        """
+        cx = np.floor((points[:, 0] - self.origin.x) / self.cell_size).astype(np.int32)
+        cy = np.floor((points[:, 1] - self.origin.y) / self.cell_size).astype(np.int32)
+        cells_y, cells_x = self.min_z.shape
+        inside = (cx >= 0) & (cx < cells_x) & (cy >= 0) & (cy < cells_y)
+
+        if not inside.any():
+            return False
+
+        return bool((points[inside, 2] < self.min_z[cy[inside], cx[inside]]).any())
+
+
+class CameraSolver:
+    """Find a camera position from which the walker can be seen.
+       Candidates are rotated around the walker by 10 degrees alternately to
+       the left and right, starting from the side where the view was last found;
+       the rotation which last gave a clear view is tried first.
+       Only a batch of candidates is ray tested in a frame, and the search is resumed
+       in the next frame; candidates buried in the terrain are skipped.
+    """
+
+    def __init__(self, queries, mask, terrains, batch=4, max_candidates=36, samples=8):
+        self.queries = queries
+        self.mask = mask
+        self.maps = [OcclusionMap(terrain) for terrain in terrains]
+        self.batch = batch
+        self.max_candidates = max_candidates
+        self.samples = np.linspace(0, 1, samples + 2)[1:-1, np.newaxis]
+        self.next_idx = 0
+        # the heading offset of the last candidate with a clear view.
+        self.last_angle = None
+        self.angles = self.get_angles()
+
+    def reset(self):
+        self.next_idx = 0
+
+    def get_angles(self):
+        """Return the heading offsets of the candidates in order; None is the default position."""
+        sign = -1 if self.last_angle is not None and self.last_angle < 0 else 1
+        angles = [None]
+
+        for n in range(1, self.max_candidates // 2 + 1):
+            angles.extend([10 * n * sign, -10 * n * sign])
+
+        angles = angles[:self.max_candidates]
+
+        if self.last_angle in angles:
+            angles.remove(self.last_angle)
+            angles.insert(0, self.last_angle)
+
+        return angles
+
+    def get_candidate(self, idx, walker_pos, camera_pos, default_pos):
+        if (angle := self.angles[idx]) is None:
+            return default_pos
+
+        q = Quat()
+        q.set_from_axis_angle(angle, Vec3.up())
+        return q.xform(camera_pos - walker_pos) + walker_pos
+
+    def is_buried(self, walker_pos, candidate):
+        points = None
+
+        for occlusion_map in self.maps:
+            if not occlusion_map.may_cover(candidate, walker_pos):
+                continue
+
+            if points is None:
+                start = np.array(candidate, dtype=np.float32)
+                end = np.array(walker_pos, dtype=np.float32)
+                points = start + (end - start) * self.samples
+
+            # If the walker is above the terrain, a buried point means the view is blocked.
+            if (z := occlusion_map.terrain.height_at(walker_pos.x, walker_pos.y)) is not None \
+                    and walker_pos.z > z and occlusion_map.below(points):
+                return True
+
+        return False
+
+    def solve(self, walker_nd, walker_pos, camera_pos, default_pos):
+        """Return a camera position from which the walker can be seen, or None
+           if it is not found in this frame.
+        """
+        candidates = []
+
+        if self.next_idx == 0:
+            self.angles = self.get_angles()
+
+        while len(candidates) < self.batch:
+            idx = self.next_idx
+            self.next_idx = (self.next_idx + 1) % self.max_candidates
+            candidate = self.get_candidate(idx, walker_pos, camera_pos, default_pos)
+
+            if not self.is_buried(walker_pos, candidate):
+                candidates.append((idx, candidate))
+                self.queries.submit('camera', 'ray', candidate, walker_pos, self.mask)
+
+            if self.next_idx == 0:
+                break
+
+        for (idx, candidate), result in zip(candidates, self.queries.execute()):
+            if result.has_hit() and result.get_node() == walker_nd:
+                if (angle := self.angles[idx]) is not None:
+                    self.last_angle = angle
+                self.reset()
+                return candidate
+
+        return None
@@ -0,0 +1,208 @@
+"""Collision shapes of boxes for the models made of boxes and planes.
+
+   A triangle mesh shape is tested triangle by triangle, while a box is one convex
+   shape, so the models of the Box and Plane of the shapes package collide with boxes:
+   one box for a solid Box or a Plane, and a slab for each closed face of a hollow one.
+   The curved parts still collide with their triangle meshes.
+
+   To compare the boxes with the triangle meshes by ray and sphere sweep tests:
+   >python collision.py
+   >python collision.py --segments 5000 --name basement
+"""
+import argparse
+import random
+import time
+
+from panda3d.bullet import BulletBoxShape
+from panda3d.core import Point3, Vec3, TransformState
+
+
+class BoxCollision:
+    """Convex pieces of a Box with the thickness and the open faces of its parameters.
+       A Box without thickness is a solid box if all its faces are closed, otherwise
+       its closed faces are slabs of THIN.
+    """
+
+    THIN = 0.05
+
+    # faces at the minimum and the maximum of the x, y and z axes.
+    FACES = (('left', 'right'), ('front', 'back'), ('bottom', 'top'))
+
+    def __init__(self, thickness=0, open_top=False, open_bottom=False, open_left=False,
+                 open_right=False, open_front=False, open_back=False):
+        self.thickness = thickness
+        self.open_faces = {
+            'top': open_top, 'bottom': open_bottom, 'left': open_left,
+            'right': open_right, 'front': open_front, 'back': open_back
+        }
+
+    @classmethod
+    def from_box(cls, thickness=0, open_top=False, open_bottom=False, open_left=False,
+                 open_right=False, open_front=False, open_back=False, **dims):
+        """Make from the parameters of Box; the sizes are taken from the bounds of the model."""
+        return cls(thickness, open_top, open_bottom, open_left, open_right, open_front, open_back)
+
+    def is_solid(self, min_pt, max_pt):
+        if not self.thickness:
+            return not any(self.open_faces.values())
+
+        # the box is solid if the thickness of the closed faces fills it on any axis.
+        for axis, faces in enumerate(self.FACES):
+            closed = sum(not self.open_faces[face] for face in faces)
+            if max_pt[axis] - min_pt[axis] - self.thickness * closed <= 0:
+                return True
+
+        return False
+
+    def pieces(self, min_pt, max_pt):
+        """Return the pairs of the min and max points of the boxes in the space of the bounds."""
+        if self.is_solid(min_pt, max_pt):
+            return [self.clamp(Point3(min_pt), Point3(max_pt))]
+
+        t = self.thickness or self.THIN
+        pieces = []
+
+        for axis, faces in enumerate(self.FACES):
+            for face, is_max in zip(faces, (False, True)):
+                if self.open_faces[face]:
+                    continue
+
+                lo, hi = Point3(min_pt), Point3(max_pt)
+                if is_max:
+                    lo[axis] = max_pt[axis] - t
+                else:
+                    hi[axis] = min_pt[axis] + t
+                pieces.append(self.clamp(lo, hi))
+
+        return pieces
+
+    def clamp(self, lo, hi):
+        """Give a flat piece, like a Plane, the thickness of THIN below its surface."""
+        for axis in range(3):
+            if hi[axis] - lo[axis] < self.THIN:
+                lo[axis] = hi[axis] - self.THIN
+        return lo, hi
+
+    def create_shapes(self, model):
+        """Return the pairs of a BulletBoxShape and its transform in the space of the model."""
+        min_pt, max_pt = model.get_tight_bounds(model)
+        shapes = []
+
+        for lo, hi in self.pieces(min_pt, max_pt):
+            shape = BulletBoxShape(Vec3(hi - lo) / 2)
+            shapes.append((shape, TransformState.make_pos((lo + hi) / 2)))
+
+        return shapes
+
+
+def random_segments(min_pt, max_pt, n, rng):
+    """Return n segments between random points in the bounds."""
+    def random_point():
+        return Point3(*(rng.uniform(lo, hi) for lo, hi in zip(min_pt, max_pt)))
+
+    return [(random_point(), random_point()) for _ in range(n)]
+
+
+def hit_distance(result, from_pos, to_pos):
+    if result.has_hit():
+        return result.get_hit_fraction() * (to_pos - from_pos).length()
+
+
+def compare_worlds(mesh_world, box_world, segments, radius=0.5, tolerance=0.1):
+    """Cast rays and sweep spheres along the segments in both worlds and
+       return the numbers of the differences and the times of the queries.
+    """
+    from panda3d.bullet import BulletSphereShape
+    from panda3d.core import BitMask32
+
+    mask = BitMask32.all_on()
+    sphere = BulletSphereShape(radius)
+    result = {}
+
+    queries = {
+        'ray': lambda world, a, b: world.ray_test_closest(a, b, mask),
+        'sweep': lambda world, a, b: world.sweep_test_closest(
+            sphere, TransformState.make_pos(a), TransformState.make_pos(b), mask),
+    }
+
+    for name, query in queries.items():
+        distances = {}
+
+        for key, world in [('mesh', mesh_world), ('box', box_world)]:
+            start = time.perf_counter()
+            distances[key] = [hit_distance(query(world, a, b), a, b) for a, b in segments]
+            result[f'{name}_{key}_us'] = (time.perf_counter() - start) / len(segments) * 1e6
+
+        differ = 0
+        max_diff = 0
+
+        for mesh_d, box_d in zip(distances['mesh'], distances['box']):
+            if (mesh_d is None) != (box_d is None):
+                differ += 1
+            elif mesh_d is not None:
+                max_diff = max(max_diff, abs(mesh_d - box_d))
+                differ += abs(mesh_d - box_d) > tolerance
+
+        result[f'{name}_differ'] = differ
+        result[f'{name}_max_diff'] = max_diff
+
+    return result
+
+
+def main():
+    from direct.showbase.ShowBase import ShowBase
+    from panda3d.bullet import BulletWorld
+    from panda3d.core import load_prc_file_data
+
+    from scene import ModelRoot, Sensor, Sensors, MODEL_TYPES, read_description
+
+    parser = argparse.ArgumentParser(description='Compare the box collision shapes with the triangle meshes.')
+    parser.add_argument('--scene', default='scenes/default.json')
+    parser.add_argument('--segments', type=int, default=1000, help='number of rays and sweeps per model.')
+    parser.add_argument('--name', help='compare only the model of the attr or the sensor of the name.')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    load_prc_file_data('', """
+        window-type none
+        audio-library-name null""")
+
+    ShowBase()
+    rng = random.Random(args.seed)
+
+    desc = read_description(args.scene)
+
+    makers = [(spec['attr'], lambda spec=spec: MODEL_TYPES[spec['type']](**spec.get('params', {})))
+              for spec in desc['models']]
+
+    for i, spec in enumerate(desc['sensors']):
+        name = spec.get('name', f'sensor_{i}')
+        makers.append((name, lambda spec=spec, name=name: Sensor(
+            name, Sensors[spec['type']], spec['width'], spec['depth'])))
+
+    for name, make in makers:
+        if args.name and name != args.name:
+            continue
+
+        worlds = {}
+        for simple in (False, True):
+            ModelRoot.SIMPLE_COLLISION = simple
+            worlds[simple] = BulletWorld()
+            worlds[simple].attach((model := make()).node())
+
+            if not simple:
+                min_pt, max_pt = model.get_tight_bounds()
+
+        # the segments also start and end around the model.
+        margin = Vec3(2, 2, 2)
+        segments = random_segments(min_pt - margin, max_pt + margin, args.segments, rng)
+        result = compare_worlds(worlds[False], worlds[True], segments)
+
+        print(f"{name}: rays {result['ray_differ']}/{args.segments} differ (max {result['ray_max_diff']:.3f}), "
+              f"{result['ray_mesh_us']:.1f}us -> {result['ray_box_us']:.1f}us; "
+              f"sweeps {result['sweep_differ']}/{args.segments} differ (max {result['sweep_max_diff']:.3f}), "
+              f"{result['sweep_mesh_us']:.1f}us -> {result['sweep_box_us']:.1f}us")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,303 @@
+import numpy as np
+from direct.actor.Actor import Actor
+from panda3d.core import Point3, TransformState, BitMask32
+
+from instrumentation import timed, instruments
+from scene import Sensors, Sensor
+from walker import Walker, Status
+
+
+class SensorPlanes:
+    """The sensors of the scene as planes, to find the sensors under many points at once.
+       A point is over a sensor if it is inside the bounds of the sensor on its plane
+       and above the plane by up to depth, like Scene.check_sensors.
+    """
+
+    def __init__(self, sensors):
+        self.sensors = list(sensors)
+        self.index = {sensor.get_name(): i for i, sensor in enumerate(self.sensors)}
+        self.masks = np.array([sensor.sensor.mask for sensor in self.sensors])
+        self.locations = np.array([sensor.location for sensor in self.sensors])
+        self.to_local = np.array([base.render.get_mat(sensor) for sensor in self.sensors], dtype=np.float32)
+        self.bounds = np.array([[tuple(pt) for pt in sensor.get_tight_bounds(sensor)] for sensor in self.sensors],
+                               dtype=np.float32)
+
+        # index of dest_sensor, -1 if none.
+        self.dest = np.array([-1 if sensor.dest_sensor is None else self.index[sensor.dest_sensor.get_name()]
+                              for sensor in self.sensors], dtype=np.int32)
+
+    def local_points(self, i, points):
+        pts = np.concatenate([points, np.ones((len(points), 1), dtype=np.float32)], axis=1)
+        return (pts @ self.to_local[i])[:, :3]
+
+    def find(self, points, mask, depth=5):
+        """Return the index of the sensor of the mask under each point, -1 if none."""
+        found = np.full(len(points), -1, dtype=np.int32)
+
+        for i in np.nonzero(self.masks == mask)[0]:
+            local = self.local_points(i, points)
+            (min_x, min_y, _), (max_x, max_y, _) = self.bounds[i]
+            # the height above the plane along world z.
+            height = local[:, 2] / self.to_local[i, 2, 2]
+            inside = (local[:, 0] >= min_x) & (local[:, 0] <= max_x) \
+                & (local[:, 1] >= min_y) & (local[:, 1] <= max_y) & (height >= 0) & (height <= depth)
+            found = np.where((found < 0) & inside, i, found)
+
+        return found
+
+    def plane_z(self, ids, points):
+        """Return the z of the planes of the sensors ids right below or above the points."""
+        z = np.empty(len(points), dtype=np.float32)
+
+        for i in np.unique(ids):
+            sel = ids == i
+            local = self.local_points(i, points[sel])
+            z[sel] = points[sel, 2] - local[:, 2] / self.to_local[i, 2, 2]
+
+        return z
+
+
+class Crowd:
+    """NPC walkers whose states are held in NumPy arrays and updated in bulk.
+       They follow the state machine of Walker: the heights of the terrains and the
+       sensors under them are calculated for all the agents at once, and Bullet is
+       queried only for the agents near the assembled models. All the agents share
+       two Actors, one running and one posed, through instancing.
+    """
+
+    GROUND_MASK = BitMask32.bit(1) | BitMask32.bit(3) | BitMask32.bit(6)
+    COLLISION_MASK = BitMask32.bit(2) | BitMask32.bit(3)
+    MOVE, FALLING, INTO_ROOM, IN_ROOM = (Status.MOVE.value, Status.FALLING.value,
+                                         Status.INTO_ROOM.value, Status.IN_ROOM.value)
+
+    def __init__(self, scene, n, area=(-60, -60, 60, 60), top=0, speed=(2, 5), seed=None):
+        self.scene = scene
+        self.n = n
+        self.rng = np.random.default_rng(seed)
+        self.pos = np.zeros((n, 3), dtype=np.float32)
+        self.heading = self.rng.uniform(0, 360, n).astype(np.float32)
+        self.speed = self.rng.uniform(*speed, n).astype(np.float32)
+        self.turn_rate = np.zeros(n, dtype=np.float32)
+        self.status = np.full(n, self.MOVE, dtype=np.int8)
+        self.sensor = np.full(n, -1, dtype=np.int32)
+
+        self.refresh()
+        self.spawn(area, top)
+        self.setup_nodes()
+
+    def spawn(self, area, top, tries=100):
+        x0, y0, x1, y1 = area
+        todo = np.arange(self.n)
+
+        for _ in range(tries):
+            self.pos[todo, 0] = self.rng.uniform(x0, x1, len(todo))
+            self.pos[todo, 1] = self.rng.uniform(y0, y1, len(todo))
+            self.pos[todo, 2] = top
+            z = self.ground_z(self.pos[todo], -100, BitMask32.bit(1))
+            found = ~np.isnan(z)
+
+            # the ground under the mountains is inside the rock, so the agents would start buried.
+            for terrain in self.mountains:
+                found &= ~(terrain.heights_at(self.pos[todo, 0], self.pos[todo, 1]) > z)
+
+            self.pos[todo[found], 2] = z[found] + 1.5
+
+            if not len(todo := todo[~found]):
+                break
+
+    def refresh(self):
+        """Copy the sensors, the mountains and the models of the scene, again when they have changed."""
+        self.revision = self.scene.revision
+        old_planes = getattr(self, 'planes', None)
+        self.planes = SensorPlanes(model for model in self.scene.natures if isinstance(model, Sensor))
+
+        if old_planes is not None:
+            # the falling agents keep their sensors by name; -1 is mapped to -1 by the last item.
+            remap = np.array([self.planes.index.get(sensor.get_name(), -1) for sensor in old_planes.sensors] + [-1])
+            self.sensor = remap[self.sensor].astype(np.int32)
+            lost = (self.sensor < 0) & np.isin(self.status, (self.FALLING, self.INTO_ROOM))
+            self.status[lost] = self.MOVE
+
+        self.mountains = [t for t in self.scene.terrains if not (t.get_collide_mask() & BitMask32.bit(2)).is_zero()]
+        self.setup_models()
+
+    def setup_models(self):
+        """Copy the bounding boxes of the models in the model index to arrays,
+           to find the agents which may hit them without querying the index for each agent.
+        """
+        models = [(item.get_collide_mask().get_word(), tuple(min_pt), tuple(max_pt))
+                  for item, min_pt, max_pt in self.scene.model_index.entries()]
+        masks, min_pts, max_pts = zip(*models) if models else ((), (), ())
+        self.model_masks = np.array(masks, dtype=np.uint32)
+        self.model_min = np.array(min_pts, dtype=np.float32).reshape(-1, 3)
+        self.model_max = np.array(max_pts, dtype=np.float32).reshape(-1, 3)
+
+    def may_hit_models(self, from_pts, to_pts, mask):
+        """Return True for the segments overlapping the bounding boxes of the models of the mask."""
+        sel = (self.model_masks & mask.get_word()) != 0
+        lo = np.minimum(from_pts, to_pts)[:, np.newaxis]
+        hi = np.maximum(from_pts, to_pts)[:, np.newaxis]
+        return ((lo <= self.model_max[sel]) & (hi >= self.model_min[sel])).all(axis=2).any(axis=1)
+
+    def setup_nodes(self):
+        self.root = self.scene.root.attach_new_node('crowd')
+        anims = {Walker.RUN: 'models/ralph/ralph-run.egg', Walker.WALK: 'models/ralph/ralph-walk.egg'}
+        self.running = Actor('models/ralph/ralph.egg', anims)
+        self.running.loop(Walker.RUN)
+        self.posed = Actor('models/ralph/ralph.egg', anims)
+        self.posed.pose(Walker.WALK, 5)
+
+        self.nodes = []
+        self.running_now = np.ones(self.n, dtype=bool)
+
+        for i in range(self.n):
+            nd = self.root.attach_new_node(f'agent_{i}')
+            nd.set_scale(0.5)
+            holder = nd.attach_new_node('actor')
+            holder.set_transform(TransformState.make_pos(Walker.ACTOR_POS))
+            self.running.instance_to(holder)
+            self.nodes.append(nd)
+
+        self.update_nodes()
+
+    def ground_z(self, points, distance, mask=GROUND_MASK):
+        """Return the z of the closest ground below the points within the distance, nan if none."""
+        z = np.full(len(points), np.nan, dtype=np.float32)
+        bottom = points[:, 2] + distance
+
+        for terrain in self.scene.terrains:
+            if (terrain.get_collide_mask() & mask).is_zero():
+                continue
+            hz = terrain.heights_at(points[:, 0], points[:, 1])
+            hz = np.where((hz <= points[:, 2]) & (hz >= bottom), hz, np.nan)
+            z = np.fmax(z, hz)
+
+        # the terrains are done, so only the models are ray tested.
+        if (model_mask := mask & ~self.scene.terrain_mask).is_zero():
+            return z
+
+        to_pts = points.copy()
+        to_pts[:, 2] = bottom
+
+        for i in np.nonzero(self.may_hit_models(points, to_pts, model_mask))[0]:
+            if (hit := self.scene.queries.ray_test(
+                    'crowd', Point3(*points[i]), Point3(*to_pts[i]), model_mask)).has_hit():
+                z[i] = np.fmax(z[i], hit.get_hit_pos().z)
+
+        return z
+
+    def blocked(self, current, points):
+        """Return True for the agents which will hit the mountains or the models."""
+        blocked = np.zeros(len(points), dtype=bool)
+
+        # the mountain surfaces crossed by the bottoms of the agents.
+        for terrain in self.mountains:
+            below = terrain.heights_at(current[:, 0], current[:, 1]) <= current[:, 2] - 0.5
+            blocked |= below & (terrain.heights_at(points[:, 0], points[:, 1]) > points[:, 2] - 0.5)
+
+        # Walker uses sweep tests, but a ray ahead by the radius is enough for the agents and much cheaper.
+        model_mask = self.COLLISION_MASK & ~self.scene.terrain_mask
+
+        ahead = points - current
+        ahead *= 0.5 / np.maximum(np.linalg.norm(ahead, axis=1, keepdims=True), 1e-6)
+        ahead += points
+
+        for i in np.nonzero(self.may_hit_models(current, ahead, model_mask))[0]:
+            if self.scene.queries.ray_test(
+                    'crowd', Point3(*current[i]), Point3(*ahead[i]), model_mask).has_hit():
+                blocked[i] = True
+
+        if blocked.any():
+            # entrances and exits of tunnels let the agents pass.
+            idx = np.nonzero(blocked)[0]
+            blocked[idx[self.planes.find(points[idx], Sensors.TUNNEL.mask) >= 0]] = False
+
+        return blocked
+
+    def wander(self, idx, dt):
+        self.turn_rate[idx] += self.rng.normal(0, 60, len(idx)).astype(np.float32) * dt
+        self.turn_rate[idx] = np.clip(self.turn_rate[idx], -90, 90)
+        self.heading[idx] = (self.heading[idx] + self.turn_rate[idx] * dt) % 360
+
+    def move(self, idx, dt):
+        current = self.pos[idx]
+        rad = np.radians(self.heading[idx])
+        step = (self.speed[idx] * dt)[:, np.newaxis]
+        next_pos = current.copy()
+        next_pos[:, :2] += np.stack([np.sin(rad), -np.cos(rad)], axis=1) * step
+        ground = np.full(len(idx), np.nan, dtype=np.float32)
+
+        # holes: fall into them, if the landing points are far.
+        hole = self.planes.find(current, Sensors.HOLE.mask)
+        hole = np.where(hole >= 0, hole, self.planes.find(next_pos, Sensors.HOLE.mask))
+        in_room = self.status[idx] == self.IN_ROOM
+
+        # agents in the room go out through the hole.
+        self.status[idx[in_room & (hole >= 0)]] = self.MOVE
+
+        if (entering := np.nonzero(~in_room & (hole >= 0) & (self.planes.dest[hole] >= 0))[0]).size:
+            dest = self.planes.dest[hole[entering]]
+            dest_z = self.planes.plane_z(dest, next_pos[entering])
+            near = dest_z >= next_pos[entering, 2] - 3
+            ground[entering[near]] = dest_z[near]
+
+            falling = entering[~near]
+            agents = idx[falling]
+            self.pos[agents] = next_pos[falling]
+            self.sensor[agents] = hole[falling]
+            to_room = self.planes.locations[dest[~near]] == Sensors.STEPS.location
+            self.status[agents] = np.where(to_room, self.INTO_ROOM, self.FALLING)
+
+        moving = np.isin(self.status[idx], (self.MOVE, self.IN_ROOM))
+        todo = np.nonzero(moving & np.isnan(ground))[0]
+        ground[todo] = self.ground_z(next_pos[todo], -2.5)
+
+        ok = np.nonzero(moving & ~np.isnan(ground))[0]
+        next_pos[ok, 2] = ground[ok] + 1.5
+        blocked = self.blocked(current[ok], next_pos[ok])
+        go = ok[~blocked]
+        self.pos[idx[go]] = next_pos[go]
+
+        # turn back the agents which cannot move.
+        stuck = idx[np.setdiff1d(np.nonzero(moving)[0], go)]
+        self.heading[stuck] = (self.heading[stuck] + self.rng.uniform(90, 270, len(stuck))) % 360
+        self.turn_rate[stuck] = 0
+
+    def fall(self, idx, dt):
+        self.pos[idx, 2] -= 20 * dt
+        dest = self.planes.dest[self.sensor[idx]]
+        landed = self.pos[idx, 2] - 1.5 <= self.planes.plane_z(dest, self.pos[idx])
+        agents = idx[landed]
+        self.status[agents] = np.where(self.status[agents] == self.INTO_ROOM, self.IN_ROOM, self.MOVE)
+        self.sensor[agents] = -1
+
+    def update_nodes(self):
+        running = np.isin(self.status, (self.MOVE, self.IN_ROOM))
+
+        for i in np.nonzero(running != self.running_now)[0]:
+            holder = self.nodes[i].get_child(0)
+            holder.node().remove_all_children()
+            (self.running if running[i] else self.posed).instance_to(holder)
+
+        self.running_now = running
+
+        for nd, (x, y, z), h in zip(self.nodes, self.pos.tolist(), self.heading.tolist()):
+            nd.set_pos_hpr(x, y, z, h, 0, 0)
+
+    @timed('crowd:update')
+    def update(self, dt):
+        if self.revision != self.scene.revision:
+            self.refresh()
+
+        walking = np.nonzero(np.isin(self.status, (self.MOVE, self.IN_ROOM)))[0]
+        self.wander(walking, dt)
+        self.move(walking, dt)
+
+        if (falling := np.nonzero(np.isin(self.status, (self.FALLING, self.INTO_ROOM)))[0]).size:
+            self.fall(falling, dt)
+
+        instruments.count('crowd:agents', self.n)
+        self.update_nodes()
+
+    def counts(self):
+        return {Status(value).name: int((self.status == value).sum()) for value in np.unique(self.status)}
@@ -0,0 +1,74 @@
+import numpy as np
+
+
+def texture_channel(tex, channel='R'):
+    """Return one channel of a texture as a float32 array of shape (y_size, x_size)
+       normalized to [0, 1]. Row 0 is the bottom row of the image, so an element
+       [j, i] corresponds to the heightfield grid point (i, j).
+    """
+    dtype = np.uint16 if tex.get_component_width() == 2 else np.uint8
+    arr = np.frombuffer(tex.get_ram_image_as(channel), dtype=dtype)
+    arr = arr.reshape(tex.get_y_size(), tex.get_x_size())
+    return arr.astype(np.float32) / np.iinfo(dtype).max
+
+
+# corners of the two triangles in a cell as (di, dj) offsets from the cell origin.
+# BulletHeightfieldShape with diamond subdivision flips the diagonal every other cell.
+EVEN_TRIANGLES = np.array([[[0, 0], [1, 0], [1, 1]], [[0, 0], [1, 1], [0, 1]]], dtype=np.int32)
+ODD_TRIANGLES = np.array([[[0, 0], [1, 0], [0, 1]], [[1, 0], [1, 1], [0, 1]]], dtype=np.int32)
+
+
+def locate_triangles(heights, gx, gy):
+    """Return the cells (i, j), the triangle index k in each cell and the
+       fractional position (fx, fy) in the cell of the grid coordinates (gx, gy).
+    """
+    rows, cols = heights.shape
+    i = np.clip(np.floor(gx).astype(np.int32), 0, cols - 2)
+    j = np.clip(np.floor(gy).astype(np.int32), 0, rows - 2)
+    fx = gx - i
+    fy = gy - j
+
+    even = (i + j) % 2 == 0
+    k = np.where(even, fx < fy, fx + fy > 1).astype(np.int32)
+    return i, j, k, fx, fy
+
+
+def grid_triangles(i0, j0, i1, j1):
+    """Return the grid coordinates of the triangle corners in the cells from
+       (i0, j0) to (i1, j1) exclusive, as an array of shape (j1 - j0, i1 - i0, 2, 3, 2).
+    """
+    j, i = np.mgrid[j0:j1, i0:i1].astype(np.int32)
+    even = ((i + j) % 2 == 0)[..., None, None, None]
+    corners = np.where(even, EVEN_TRIANGLES, ODD_TRIANGLES)
+    return corners + np.stack([i, j], axis=-1)[:, :, None, None, :]
+
+
+def sample_heights(heights, gx, gy):
+    """Interpolate the heightfield at the grid coordinates (gx, gy) over the
+       triangles of BulletHeightfieldShape with diamond subdivision.
+       gx and gy can be scalars or arrays; nan is returned outside the grid.
+    """
+    gx = np.asarray(gx, dtype=np.float32)
+    gy = np.asarray(gy, dtype=np.float32)
+    rows, cols = heights.shape
+    inside = (gx >= 0) & (gx <= cols - 1) & (gy >= 0) & (gy <= rows - 1)
+    i, j, k, fx, fy = locate_triangles(heights, gx, gy)
+
+    h00 = heights[j, i]
+    h10 = heights[j, i + 1]
+    h01 = heights[j + 1, i]
+    h11 = heights[j + 1, i + 1]
+
+    even = (i + j) % 2 == 0
+    z_even = np.where(
+        k == 0,
+        h00 + fx * (h10 - h00) + fy * (h11 - h10),
+        h00 + fy * (h01 - h00) + fx * (h11 - h01)
+    )
+    z_odd = np.where(
+        k == 0,
+        h00 + fx * (h10 - h00) + fy * (h01 - h00),
+        h11 + (1 - fx) * (h01 - h11) + (1 - fy) * (h10 - h11)
+    )
+    z = np.where(even, z_even, z_odd)
+    return np.where(inside, z, np.nan)
@@ -0,0 +1,193 @@
+"""Per-frame counters and timers reported by the hot paths.
+
+   Functions decorated with timed and calls to count only check a flag while the
+   instruments are disabled. When enabled, the values of each frame are kept in a
+   rolling history, which can be shown with Overlay, sent to PStats and dumped to
+   a CSV or JSON file.
+"""
+import csv
+import functools
+import json
+import time
+from collections import Counter, defaultdict, deque
+
+import numpy as np
+from direct.gui.OnscreenText import OnscreenText
+from panda3d.core import PStatClient, PStatCollector, TextNode
+
+
+# upper edges of the timer histogram bins in milliseconds.
+BINS_MS = (0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1, 2, 5, 10, 20, 50, float('inf'))
+
+
+class Instruments:
+
+    def __init__(self, history=600):
+        self.enabled = False
+        self.pstats = False
+        self.frames = deque(maxlen=history)
+        self.counts = Counter()
+        self.times = defaultdict(float)
+        self.histograms = defaultdict(lambda: np.zeros(len(BINS_MS), dtype=np.int64))
+        self.collectors = {}
+        self.dump_path = None
+        self.dump_interval = 0
+        self.frame = 0
+
+    def enable(self, dump_path=None, dump_interval=300):
+        """Start recording. If dump_path is given, the history is written to it,
+           as CSV or JSON by its extension, every dump_interval frames.
+        """
+        self.enabled = True
+        self.dump_path = dump_path
+        self.dump_interval = dump_interval
+
+    def disable(self):
+        self.enabled = False
+        self.counts.clear()
+        self.times.clear()
+
+    def connect_pstats(self, host='', port=-1):
+        """Connect to the PStats server; the timers and counters are sent as collectors."""
+        self.pstats = PStatClient.connect(host, port)
+        return self.pstats
+
+    def reset(self):
+        self.frames.clear()
+        self.counts.clear()
+        self.times.clear()
+        self.histograms.clear()
+
+    def get_collector(self, name):
+        if (collector := self.collectors.get(name)) is None:
+            collector = self.collectors[name] = PStatCollector(f'Instruments:{name}')
+        return collector
+
+    def count(self, name, n=1):
+        if self.enabled:
+            self.counts[name] += n
+
+    def add_time(self, name, seconds):
+        self.times[name] += seconds
+        self.counts[name] += 1
+        self.histograms[name][np.searchsorted(BINS_MS, seconds * 1000)] += 1
+
+    def end_frame(self):
+        """Close the values of the frame and start the next one."""
+        if not self.enabled:
+            return
+
+        self.frame += 1
+        record = {'frame': self.frame}
+        record.update(self.counts)
+        record.update({f'{name}_ms': seconds * 1000 for name, seconds in self.times.items()})
+        self.frames.append(record)
+
+        if self.pstats:
+            for name, n in self.counts.items():
+                if name not in self.times:
+                    self.get_collector(name).set_level(n)
+
+        self.counts.clear()
+        self.times.clear()
+
+        if self.dump_path and self.dump_interval and self.frame % self.dump_interval == 0:
+            self.dump(self.dump_path)
+
+    def summary(self):
+        """Return the mean and max per frame of the values in the history,
+           and the histograms of the timers.
+        """
+        names = sorted({name for record in self.frames for name in record if name != 'frame'})
+        result = {}
+
+        for name in names:
+            values = [record.get(name, 0) for record in self.frames]
+            result[name] = {'mean': sum(values) / len(values), 'max': max(values)}
+
+        for name, hist in self.histograms.items():
+            result.setdefault(f'{name}_ms', {})['histogram'] = {
+                f'<{edge}': int(n) for edge, n in zip(BINS_MS, hist) if n
+            }
+
+        return result
+
+    def dump(self, path):
+        if path.endswith('.json'):
+            with open(path, 'w') as f:
+                json.dump({'frames': list(self.frames), 'summary': self.summary()}, f, indent=2)
+            return
+
+        names = sorted({name for record in self.frames for name in record if name != 'frame'})
+        with open(path, 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=['frame', *names], restval=0)
+            writer.writeheader()
+            writer.writerows(self.frames)
+
+
+instruments = Instruments()
+
+
+def timed(name):
+    """Decorator to record the time of each call of the function as name."""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not instruments.enabled:
+                return func(*args, **kwargs)
+
+            if instruments.pstats:
+                collector = instruments.get_collector(name)
+                collector.start()
+
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                instruments.add_time(name, time.perf_counter() - start)
+                if instruments.pstats:
+                    collector.stop()
+
+        return wrapper
+    return decorator
+
+
+class Overlay:
+    """Show the counters and timers averaged over the last frames on the screen."""
+
+    def __init__(self, frames=60):
+        self.frames = frames
+        self.text = OnscreenText(
+            parent=base.a2dTopLeft, pos=(0.05, -0.1), scale=0.04,
+            fg=(1, 1, 1, 1), bg=(0, 0, 0, 0.5), align=TextNode.A_left, mayChange=True
+        )
+        self.text.hide()
+
+    def is_shown(self):
+        return not self.text.is_hidden()
+
+    def toggle(self):
+        if self.is_shown():
+            self.text.hide()
+            # keep recording only for the dump or PStats.
+            if not (instruments.dump_path or instruments.pstats):
+                instruments.disable()
+        else:
+            instruments.enable(instruments.dump_path, instruments.dump_interval)
+            self.text.show()
+
+    def update(self):
+        if not self.is_shown() or not instruments.frames:
+            return
+
+        records = list(instruments.frames)[-self.frames:]
+        names = sorted({name for record in records for name in record if name != 'frame'})
+        lines = []
+
+        for name in names:
+            values = [record.get(name, 0) for record in records]
+            fmt = '{:.3f}' if name.endswith('_ms') else '{:.1f}'
+            mean = fmt.format(sum(values) / len(values))
+            lines.append(f'{name}: {mean} (max {fmt.format(max(values))})')
+
+        self.text.setText('\n'.join(lines))
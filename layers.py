@@ -0,0 +1,71 @@
+from panda3d.bullet import BulletWorld, BulletRigidBodyNode
+from panda3d.core import NodePath
+
+
+class LayeredWorld:
+    """Query-only BulletWorlds, one for each vertical zone, holding the static objects in the zone.
+       The objects stay attached to base.world for the physics and the contact tests;
+       each zone world has a proxy body which shares the collision shapes of the object,
+       so a ray or sweep test in a zone traverses the broadphase of the zone only.
+    """
+
+    ZONES = ('surface', 'mid', 'basement')
+
+    def __init__(self, zones=ZONES):
+        self.worlds = {zone: BulletWorld() for zone in zones}
+        # the zones of each object in order; the first one is where the object is.
+        self.zones = {}
+        self.proxies = {}
+
+    def __contains__(self, zone):
+        return zone in self.worlds
+
+    def world(self, zone):
+        return self.worlds[zone]
+
+    def create_proxy(self, model):
+        node = model.node()
+        proxy = NodePath(BulletRigidBodyNode(node.get_name()))
+        proxy.node().set_mass(0)
+
+        for i in range(node.get_num_shapes()):
+            proxy.node().add_shape(node.get_shape(i), node.get_shape_transform(i))
+
+        # static objects never move after being attached, so the transform is copied once.
+        proxy.set_transform(model.get_net_transform())
+        proxy.set_collide_mask(model.get_collide_mask())
+        return proxy
+
+    def attach(self, model, zones=None):
+        """Add the model to the zones; to all the zones if zones is None."""
+        zones = list(self.worlds) if zones is None else zones
+        attached = self.zones.setdefault(model.node(), [])
+        proxies = self.proxies.setdefault(model.node(), [])
+
+        for zone in zones:
+            if zone in attached:
+                continue
+
+            proxy = self.create_proxy(model)
+            self.worlds[zone].attach(proxy.node())
+            attached.append(zone)
+            proxies.append(proxy)
+
+    def remove(self, model):
+        for zone, proxy in zip(self.zones.pop(model.node(), []), self.proxies.pop(model.node(), [])):
+            self.worlds[zone].remove(proxy.node())
+
+    def refresh(self, model):
+        """Rebuild the proxies of the model in its zones after its shapes have been changed,
+           for example by carving holes into an attached terrain.
+        """
+        if zones := self.zones.get(model.node()):
+            zones = list(zones)
+            self.remove(model)
+            self.attach(model, zones)
+
+    def zone_of(self, node):
+        """Return the zone where the object of the node is, or None if it is not in any zone."""
+        if zones := self.zones.get(node):
+            return zones[0]
+        return None
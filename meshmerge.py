@@ -0,0 +1,107 @@
+"""Merge the geoms of procedural shapes with NumPy, a whole block of vertices at a time."""
+import numpy as np
+from panda3d.core import Geom, Mat4
+
+
+INDEX_TYPES = {Geom.NT_uint16: np.uint16, Geom.NT_uint32: np.uint32}
+
+# the largest index of 16 bit; 0xffff is reserved as the strip cut index.
+MAX_UINT16_INDEX = 0xfffe
+
+
+def placement_mat(axis_vec, bottom_center, rotation_deg):
+    """Return the matrix which rotates vertices around the axis and then moves them
+       to bottom_center, as tranform_vertices of the shapes package does.
+    """
+    return Mat4.rotate_mat(rotation_deg, axis_vec) * Mat4.translate_mat(bottom_center)
+
+
+def vertex_rows(vdata):
+    """Return the rows of the vertex data as a uint8 array of shape (rows, stride)."""
+    if vdata.get_format().get_num_arrays() != 1:
+        raise ValueError('only vertex data of one array can be merged')
+
+    array = vdata.get_array(0)
+    stride = array.get_array_format().get_stride()
+    return np.frombuffer(memoryview(array), dtype=np.uint8).reshape(-1, stride)[:vdata.get_num_rows()]
+
+
+def primitive_indices(prim):
+    if not prim.is_indexed():
+        start = prim.get_first_vertex()
+        return np.arange(start, start + prim.get_num_vertices(), dtype=np.uint32)
+
+    indices = np.frombuffer(memoryview(prim.get_vertices()), dtype=INDEX_TYPES[prim.get_index_type()])
+    return indices[:prim.get_num_vertices()]
+
+
+def transform_rows(rows, array_format, mat):
+    """Transform the points, the vectors and the normals in rows, which is modified, by mat."""
+    m = np.array(mat, dtype=np.float32)
+    # Panda3D transforms row vectors; normals are transformed by the inverse transpose.
+    linear = {
+        Geom.C_point: m[:3, :3],
+        Geom.C_vector: m[:3, :3],
+        Geom.C_normal: np.linalg.inv(m[:3, :3]).T,
+    }
+    floats = rows.view(np.float32)
+
+    for i in range(array_format.get_num_columns()):
+        column = array_format.get_column(i)
+
+        if (contents := column.get_contents()) not in linear:
+            continue
+        if column.get_numeric_type() != Geom.NT_float32 or column.get_num_components() != 3:
+            raise ValueError(f'cannot transform the column {column.get_name()}')
+
+        start = column.get_start() // 4
+        values = floats[:, start:start + 3]
+        values[:] = values @ linear[contents]
+
+        if contents == Geom.C_point:
+            values += m[3, :3]
+
+
+def merge_geoms(geom_node, parts):
+    """Append the first geoms of the parts, pairs of a GeomNode and a Mat4 to place it,
+       to the first geom of geom_node. The vertices of each part are transformed as one block
+       and the indices offset in bulk; the indices become 32 bit if 16 bit cannot hold them.
+       The merged vertices and indices are written to the geom in one copy each.
+    """
+    geom = geom_node.modify_geom(0)
+    vdata = geom.modify_vertex_data()
+    vformat = vdata.get_format()
+    prim = geom.get_primitive(0)
+
+    blocks = [vertex_rows(vdata)]
+    indices = [primitive_indices(prim).astype(np.uint32)]
+    offset = len(blocks[0])
+
+    for part_nd, mat in parts:
+        part = part_nd.get_geom(0)
+        part_vdata = part.get_vertex_data()
+
+        if part_vdata.get_format() != vformat:
+            raise ValueError('the parts must have the vertex format of the base geom')
+
+        rows = vertex_rows(part_vdata).copy()
+        transform_rows(rows, vformat.get_array(0), mat)
+        blocks.append(rows)
+        indices.append(primitive_indices(part.get_primitive(0)).astype(np.uint32) + offset)
+        offset += len(rows)
+
+    rows = np.concatenate(blocks)
+    indices = np.concatenate(indices)
+
+    vdata.unclean_set_num_rows(len(rows))
+    np.frombuffer(memoryview(vdata.modify_array(0)).cast('B'), dtype=np.uint8)[:] = rows.ravel()
+
+    prim = geom.modify_primitive(0)
+    prim.make_indexed()
+    if offset - 1 > MAX_UINT16_INDEX:
+        prim.set_index_type(Geom.NT_uint32)
+
+    prim_array = prim.modify_vertices()
+    prim_array.unclean_set_num_rows(len(indices))
+    dtype = INDEX_TYPES[prim.get_index_type()]
+    np.frombuffer(memoryview(prim_array).cast('B'), dtype=dtype)[:] = indices
@@ -0,0 +1,326 @@
+"""Navigation graph of the walkable surfaces, built offline and searched with A*.
+
+   The scene is sampled on a grid by vertical rays through all the layers, so that
+   the terrains, the tunnels, the caves and the basement become nodes. Neighbouring
+   nodes are linked if the walker could step between them, and the holes are linked
+   to the places where the walker lands after falling through them.
+
+   >python navgraph.py --output cache/navgraph.npz
+"""
+import argparse
+import heapq
+import math
+from collections import defaultdict
+
+import numpy as np
+from panda3d.bullet import BulletSphereShape
+from panda3d.core import Point3, TransformState, BitMask32
+
+from crowd import SensorPlanes
+from scene import Sensors, Sensor
+
+
+class NavGraph:
+    """Nodes on the walkable surfaces and the directed edges between them,
+       stored as arrays in compressed sparse row order.
+    """
+
+    WALK, TUNNEL, HOLE = range(3)
+
+    WALKABLE_MASK = BitMask32.bit(1) | BitMask32.bit(3) | BitMask32.bit(6)
+    COLLISION_MASK = BitMask32.bit(2) | BitMask32.bit(3)
+
+    # the center of the walker is above the ground by this, as in Walker.move.
+    CENTER_Z = 1.5
+
+    NEIGHBORS = ((1, 0), (0, 1), (1, 1), (1, -1))
+
+    def __init__(self, positions, columns, offsets, targets, costs, kinds, origin, spacing):
+        self.positions = positions
+        self.columns = columns
+        self.offsets = offsets
+        self.targets = targets
+        self.costs = costs
+        self.kinds = kinds
+        self.origin = origin
+        self.spacing = spacing
+
+        self.column_nodes = defaultdict(list)
+        for node, (i, j) in enumerate(self.columns.tolist()):
+            self.column_nodes[(i, j)].append(node)
+
+        # lists are much faster than arrays to be indexed one by one in search.
+        self.points = [tuple(pt) for pt in self.positions.tolist()]
+        self.adjacency = [
+            list(zip(self.targets[start:end].tolist(), self.costs[start:end].tolist()))
+            for start, end in zip(self.offsets[:-1].tolist(), self.offsets[1:].tolist())
+        ]
+
+    def __len__(self):
+        return len(self.positions)
+
+    @classmethod
+    def build(cls, scene, spacing=1.0, area=None, top=50, bottom=-100,
+              clearance=2.0, max_climb=1.5, min_normal_z=0.5):
+        """Sample the scene and return the graph. area is (min_x, min_y, max_x, max_y),
+           the bounds of the terrains by default. A hit on a walkable surface becomes a node
+           if it faces up and nothing is within the clearance above it. Like the ray of
+           Walker.check_downward, a step can go up or down by max_climb.
+        """
+        scene.load_all()
+
+        if area is None:
+            bounds = [terrain.get_tight_bounds(scene.root) for terrain in scene.terrains]
+            area = (min(lo.x for lo, _ in bounds), min(lo.y for lo, _ in bounds),
+                    max(hi.x for _, hi in bounds), max(hi.y for _, hi in bounds))
+
+        min_x, min_y, max_x, max_y = area
+        cols = int((max_x - min_x) / spacing) + 1
+        rows = int((max_y - min_y) / spacing) + 1
+        positions = []
+        columns = []
+
+        for i in range(cols):
+            x = min_x + i * spacing
+
+            for j in range(rows):
+                y = min_y + j * spacing
+                result = scene.queries.ray_test_all(
+                    'navgraph', Point3(x, y, top), Point3(x, y, bottom), cls.WALKABLE_MASK)
+                hits = sorted(((hit.get_hit_pos().z, hit.get_hit_normal().z) for hit in result.get_hits()),
+                              reverse=True)
+                above = math.inf
+
+                # the mountains are left to the steps, because the walker can be
+                # under their surfaces at the entrances of the tunnels.
+                for z, normal_z in hits:
+                    # two-sided surfaces and overlapping meshes are hit more than once.
+                    if above - z < 0.05:
+                        continue
+                    if normal_z >= min_normal_z and above - z >= clearance:
+                        positions.append((x, y, z))
+                        columns.append((i, j))
+                    above = z
+
+            # the results are never reused.
+            scene.queries.begin_frame()
+
+        positions = np.array(positions, dtype=np.float32).reshape(-1, 3)
+        columns = np.array(columns, dtype=np.int32).reshape(-1, 2)
+        column_nodes = defaultdict(list)
+        for node, key in enumerate(map(tuple, columns.tolist())):
+            column_nodes[key].append(node)
+
+        planes = SensorPlanes(model for model in scene.natures if isinstance(model, Sensor))
+        edges = cls.build_walk_edges(scene, planes, positions, column_nodes, max_climb)
+        edges += cls.build_hole_edges(planes, positions, column_nodes, (min_x, min_y), spacing)
+
+        sources, targets, kinds = (np.array(a, dtype=np.int32) for a in zip(*edges)) \
+            if edges else (np.zeros(0, dtype=np.int32),) * 3
+        order = np.lexsort((targets, sources))
+        sources, targets, kinds = sources[order], targets[order], kinds[order]
+        costs = np.linalg.norm(positions[targets] - positions[sources], axis=1).astype(np.float32)
+        offsets = np.searchsorted(sources, np.arange(len(positions) + 1)).astype(np.int32)
+
+        return cls(positions, columns, offsets, targets, costs, kinds.astype(np.int8),
+                   np.array([min_x, min_y], dtype=np.float32), spacing)
+
+    @classmethod
+    def build_walk_edges(cls, scene, planes, positions, column_nodes, max_climb):
+        """Link the nodes in the neighbouring columns whose heights differ by up to max_climb.
+           Like Walker.move, a step is blocked by the mountains and the models,
+           unless it goes to an entrance or an exit of a tunnel.
+        """
+        pairs = []
+        for (i, j), nodes in column_nodes.items():
+            for di, dj in cls.NEIGHBORS:
+                if not (others := column_nodes.get((i + di, j + dj))):
+                    continue
+                for a in nodes:
+                    dz = [abs(positions[b, 2] - positions[a, 2]) for b in others]
+                    if min(dz) <= max_climb:
+                        pairs.append((a, others[dz.index(min(dz))]))
+
+        if not pairs:
+            return []
+
+        a, b = np.array(pairs, dtype=np.int32).T
+        centers = positions + np.array([0, 0, cls.CENTER_Z], dtype=np.float32)
+        ca, cb = centers[a], centers[b]
+        maybe = np.zeros(len(a), dtype=bool)
+
+        # only the steps near the mountain surfaces or the models are sweep tested.
+        for terrain in scene.terrains:
+            if (terrain.get_collide_mask() & cls.COLLISION_MASK).is_zero():
+                continue
+            mid = (ca + cb) / 2
+            heights = np.stack([terrain.heights_at(pts[:, 0], pts[:, 1]) for pts in (ca, mid, cb)])
+            maybe |= np.nan_to_num(heights, nan=-np.inf).max(axis=0) >= np.minimum(ca[:, 2], cb[:, 2]) - 0.5
+
+        boxes = [(min_pt, max_pt) for item, min_pt, max_pt in scene.model_index.entries()
+                 if not (item.get_collide_mask() & cls.COLLISION_MASK & ~scene.terrain_mask).is_zero()]
+        if boxes:
+            lo = np.array([tuple(min_pt) for min_pt, _ in boxes], dtype=np.float32)
+            hi = np.array([tuple(max_pt) for _, max_pt in boxes], dtype=np.float32)
+            seg_lo = np.minimum(ca, cb)[:, np.newaxis]
+            seg_hi = np.maximum(ca, cb)[:, np.newaxis]
+            maybe |= ((seg_lo <= hi) & (seg_hi >= lo)).all(axis=2).any(axis=1)
+
+        blocked_ab = np.zeros(len(a), dtype=bool)
+        blocked_ba = np.zeros(len(a), dtype=bool)
+        shape = BulletSphereShape(0.5)
+
+        for k in np.nonzero(maybe)[0]:
+            pa, pb = Point3(*ca[k]), Point3(*cb[k])
+            ts_a, ts_b = TransformState.make_pos(pa), TransformState.make_pos(pb)
+            blocked_ab[k] = scene.queries.sweep_test('navgraph', shape, ts_a, ts_b, cls.COLLISION_MASK).has_hit()
+            blocked_ba[k] = scene.queries.sweep_test('navgraph', shape, ts_b, ts_a, cls.COLLISION_MASK).has_hit()
+
+        scene.queries.begin_frame()
+        in_tunnel = planes.find(centers, Sensors.TUNNEL.mask) >= 0
+        edges = []
+
+        for sources, targets, blocked in [(a, b, blocked_ab), (b, a, blocked_ba)]:
+            tunnel = blocked & in_tunnel[targets]
+            passable = ~blocked | tunnel
+            kinds = np.where(tunnel, cls.TUNNEL, cls.WALK)
+            edges += zip(sources[passable].tolist(), targets[passable].tolist(), kinds[passable].tolist())
+
+        return edges
+
+    @classmethod
+    def build_hole_edges(cls, planes, positions, column_nodes, origin, spacing):
+        """Link the nodes next to the hole sensors to the nodes where the walker lands,
+           on the planes of their dest_sensors.
+        """
+        centers = positions + np.array([0, 0, cls.CENTER_Z], dtype=np.float32)
+        edges = set()
+
+        # the walker reaches a hole from a node by a step to a neighbouring point, or stays on it.
+        steps = [(0, 0), *cls.NEIGHBORS, *((-di, -dj) for di, dj in cls.NEIGHBORS)]
+
+        for di, dj in steps:
+            points = centers + np.array([di * spacing, dj * spacing, 0], dtype=np.float32)
+            holes = planes.find(points, Sensors.HOLE.mask)
+
+            for node in np.nonzero((holes >= 0) & (planes.dest[holes] >= 0))[0]:
+                dest = planes.dest[holes[node]]
+                point = points[node]
+                landing_z = planes.plane_z(np.array([dest]), point[np.newaxis])[0]
+                key = (int(round((point[0] - origin[0]) / spacing)), int(round((point[1] - origin[1]) / spacing)))
+
+                # the node closest to the plane of the dest_sensor in the column of the point.
+                candidates = [(abs(positions[other, 2] - landing_z), other) for other in column_nodes.get(key, [])]
+                if candidates and (landing := min(candidates))[0] <= 1.0 and landing[1] != node:
+                    edges.add((int(node), int(landing[1]), cls.HOLE))
+
+        return list(edges)
+
+    def save(self, path):
+        np.savez_compressed(
+            path, positions=self.positions, columns=self.columns, offsets=self.offsets,
+            targets=self.targets, costs=self.costs, kinds=self.kinds,
+            origin=self.origin, spacing=np.float32(self.spacing)
+        )
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            return cls(data['positions'], data['columns'], data['offsets'], data['targets'],
+                       data['costs'], data['kinds'], data['origin'], float(data['spacing']))
+
+    def neighbors(self, node):
+        """Return the list of (node, cost) reachable from the node."""
+        return self.adjacency[node]
+
+    def nearest(self, pos, radius=2):
+        """Return the node under pos, the walker's center, which is closest to
+           its feet in the nearest column within the radius, -1 if none.
+        """
+        i = int(round((pos[0] - self.origin[0]) / self.spacing))
+        j = int(round((pos[1] - self.origin[1]) / self.spacing))
+        feet = pos[2] - self.CENTER_Z
+
+        for r in range(radius + 1):
+            ring = [(i + di, j + dj) for di in range(-r, r + 1) for dj in range(-r, r + 1)
+                    if max(abs(di), abs(dj)) == r]
+            candidates = [node for key in ring for node in self.column_nodes.get(key, [])]
+
+            if candidates:
+                return min(candidates, key=lambda node: math.dist(self.points[node], (pos[0], pos[1], feet)))
+
+        return -1
+
+    def search(self, start, goal):
+        """A* from the node start to the node goal. Returns the list of the nodes
+           of the path, or None if the goal cannot be reached. The straight line
+           distance is admissible, because every edge costs its length.
+        """
+        points = self.points
+        goal_pt = points[goal]
+        costs = {start: 0.0}
+        came_from = {start: None}
+        heap = [(math.dist(points[start], goal_pt), start)]
+
+        while heap:
+            _, node = heapq.heappop(heap)
+
+            if node == goal:
+                path = []
+                while node is not None:
+                    path.append(node)
+                    node = came_from[node]
+                return path[::-1]
+
+            cost = costs[node]
+            for other, step in self.adjacency[node]:
+                if (new_cost := cost + step) < costs.get(other, math.inf):
+                    costs[other] = new_cost
+                    came_from[other] = node
+                    heapq.heappush(heap, (new_cost + math.dist(points[other], goal_pt), other))
+
+        return None
+
+    def find_path(self, from_pos, to_pos):
+        """Return the positions of the walker's center along the path between
+           the positions as an array, or None if there is no path.
+        """
+        if (start := self.nearest(from_pos)) < 0 or (goal := self.nearest(to_pos)) < 0:
+            return None
+
+        if (path := self.search(start, goal)) is None:
+            return None
+
+        return self.positions[path] + np.array([0, 0, self.CENTER_Z], dtype=np.float32)
+
+
+def main():
+    from direct.showbase.ShowBase import ShowBase
+    from panda3d.bullet import BulletWorld
+    from panda3d.core import load_prc_file_data
+
+    from scene import Scene
+
+    parser = argparse.ArgumentParser(description='Build the navigation graph of the scene.')
+    parser.add_argument('--output', '-o', default='cache/navgraph.npz')
+    parser.add_argument('--spacing', type=float, default=1.0)
+    args = parser.parse_args()
+
+    load_prc_file_data('', """
+        window-type none
+        audio-library-name null""")
+
+    base = ShowBase()
+    # No camera is made without a window, but terrains with LOD need one as the focal point.
+    base.camera = base.render.attach_new_node('camera')
+    base.world = BulletWorld()
+    base.scene = Scene()
+    base.scene.root.reparent_to(base.render)
+
+    graph = NavGraph.build(base.scene, args.spacing)
+    graph.save(args.output)
+    print(f'{len(graph)} nodes, {len(graph.targets)} edges: {args.output}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,98 @@
+from collections import Counter
+from contextlib import contextmanager
+
+from instrumentation import instruments
+
+
+class QueryService:
+    """Run the Bullet queries issued in a frame through one place.
+       Ray and sweep tests in a frame between the same points within QUANTUM are
+       answered from the result of the first one, and the queries are counted by category for profiling.
+       Queries can also be submitted to a request list and executed together.
+       Ray and sweep tests in a route block go to the world of the zone in layers.
+    """
+
+    QUANTUM = 1e-3
+
+    def __init__(self, layers=None):
+        self.layers = layers
+        self.zone = None
+        self.results = {}
+        self.requests = []
+        self.counts = Counter()
+        self.deduped = Counter()
+
+    def begin_frame(self):
+        """Forget the results of the last frame, because objects may have moved."""
+        self.results.clear()
+
+    @contextmanager
+    def route(self, zone):
+        """Run the ray and sweep tests in the block against the world of the zone.
+           They go to base.world if zone is None or not in the layers.
+        """
+        prev, self.zone = self.zone, zone
+        try:
+            yield
+        finally:
+            self.zone = prev
+
+    def get_world(self):
+        if self.layers is None or self.zone not in self.layers:
+            return base.world
+        return self.layers.world(self.zone)
+
+    def reset_counts(self):
+        self.counts.clear()
+        self.deduped.clear()
+
+    def report(self):
+        return {category: {'queries': n, 'deduped': self.deduped[category]}
+                for category, n in self.counts.items()}
+
+    def quantize(self, pos):
+        return tuple(round(v / self.QUANTUM) for v in pos)
+
+    def run(self, category, key, query, *args):
+        self.counts[category] += 1
+
+        if (result := self.results.get(key)) is not None:
+            self.deduped[category] += 1
+            return result
+
+        instruments.count(f'{key[0]}_test')
+        result = self.results[key] = query(*args)
+        return result
+
+    def ray_test(self, category, from_pos, to_pos, mask):
+        key = ('ray', self.quantize(from_pos), self.quantize(to_pos), mask.get_word(), self.zone)
+        return self.run(category, key, self.get_world().ray_test_closest, from_pos, to_pos, mask)
+
+    def ray_test_all(self, category, from_pos, to_pos, mask):
+        key = ('ray_all', self.quantize(from_pos), self.quantize(to_pos), mask.get_word(), self.zone)
+        return self.run(category, key, self.get_world().ray_test_all, from_pos, to_pos, mask)
+
+    def sweep_test(self, category, shape, ts_from, ts_to, mask, penetration=0.0):
+        key = ('sweep', id(shape), self.quantize(ts_from.get_pos()), self.quantize(ts_to.get_pos()),
+               mask.get_word(), self.zone)
+        return self.run(category, key, self.get_world().sweep_test_closest, shape, ts_from, ts_to, mask, penetration)
+
+    def contact_test_pair(self, category, node_a, node_b):
+        # The result depends on the current transforms of the nodes, so it is never reused.
+        # The walker and the other moving nodes are only in base.world.
+        self.counts[category] += 1
+        instruments.count('contact_test')
+        return base.world.contact_test_pair(node_a, node_b)
+
+    def submit(self, category, kind, *args):
+        """Add a query to the request list; kind is 'ray' or 'sweep' and args are the
+           arguments of ray_test or sweep_test. Returns the index of the result.
+        """
+        self.requests.append((kind, category, args))
+        return len(self.requests) - 1
+
+    def execute(self):
+        """Execute all the submitted queries and return their results in order."""
+        requests, self.requests = self.requests, []
+        methods = {'ray': self.ray_test, 'sweep': self.sweep_test}
+        return [methods[kind](category, *args) for kind, category, args in requests]
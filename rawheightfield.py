@@ -0,0 +1,225 @@
+"""Binary heightfield format read through mmap, so that only the touched pages are loaded.
+
+   The file has a header, the heights in grid order (row 0 is j = 0) as uint16 or float32
+   normalized to [0, 1], the min/max pyramid of the blocks, and the hole bitplane.
+   Each section starts on an allocation boundary so that it can be mapped by itself.
+
+   >python rawheightfield.py terrains/top_terrain.png terrains/mid_terrain.png
+   >python rawheightfield.py terrains/top_ground.png --dtype float32 --block-size 16
+"""
+import argparse
+import mmap
+import os
+import struct
+
+import numpy as np
+from panda3d.core import Filename, PNMImage, Texture
+
+from heightfield import texture_channel
+
+
+MAGIC = b'HFD1'
+VERSION = 1
+EXTENSION = '.hfd'
+
+# magic, version, dtype code, cols, rows, block size, pyramid levels, data, pyramid and holes offsets.
+HEADER = struct.Struct('<4sHHIIII3Q')
+DTYPES = {1: np.dtype('<u2'), 2: np.dtype('<f4')}
+
+
+def align(offset):
+    return -(-offset // mmap.ALLOCATIONGRANULARITY) * mmap.ALLOCATIONGRANULARITY
+
+
+def build_pyramid(heights, block_size):
+    """Return the min/max of the heights in each block of block_size cells, and then
+       in each 2 x 2 blocks of the previous level, until one block is left.
+       The points on a block border are included in both blocks.
+    """
+    rows, cols = heights.shape
+    blocks_y = -(-(rows - 1) // block_size)
+    blocks_x = -(-(cols - 1) // block_size)
+    level = np.empty((blocks_y, blocks_x, 2), dtype=np.float32)
+
+    for by in range(blocks_y):
+        for bx in range(blocks_x):
+            block = heights[by * block_size:(by + 1) * block_size + 1, bx * block_size:(bx + 1) * block_size + 1]
+            level[by, bx] = block.min(), block.max()
+
+    levels = [level]
+
+    while level.shape[0] > 1 or level.shape[1] > 1:
+        # pad odd sizes by repeating the last block.
+        padded = np.pad(level, ((0, level.shape[0] % 2), (0, level.shape[1] % 2), (0, 0)), mode='edge')
+        quads = padded.reshape(padded.shape[0] // 2, 2, padded.shape[1] // 2, 2, 2)
+        level = np.stack([quads[..., 0].min(axis=(1, 3)), quads[..., 1].max(axis=(1, 3))], axis=-1)
+        levels.append(level)
+
+    return levels
+
+
+def write_raw(path, heights, holes=None, dtype='uint16', block_size=8):
+    """Write heights, a float array of shape (rows, cols) in [0, 1] indexed [j, i],
+       and holes, a bool array of the same shape, to path.
+    """
+    code = next(code for code, dt in DTYPES.items() if dt == np.dtype(dtype).newbyteorder('<'))
+    rows, cols = heights.shape
+    heights = np.clip(heights, 0, 1)
+
+    if code == 1:
+        data = np.round(heights * 65535).astype('<u2')
+    else:
+        data = heights.astype('<f4')
+
+    # the pyramid is built from the stored values, so that it bounds them exactly.
+    levels = build_pyramid(data.astype(np.float32) / 65535 if code == 1 else data, block_size)
+    pyramid = np.concatenate([level.ravel() for level in levels]).astype('<f4')
+    bits = np.packbits(np.zeros(heights.shape, dtype=bool) if holes is None else holes, axis=1)
+
+    data_offset = align(HEADER.size)
+    pyramid_offset = align(data_offset + data.nbytes)
+    holes_offset = align(pyramid_offset + pyramid.nbytes)
+
+    with open(path, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, VERSION, code, cols, rows, block_size, len(levels),
+                            data_offset, pyramid_offset, holes_offset))
+
+        for offset, section in [(data_offset, data), (pyramid_offset, pyramid), (holes_offset, bits)]:
+            f.seek(offset)
+            f.write(section.tobytes())
+
+
+def convert_png(src, dst=None, dtype='uint16', block_size=8):
+    """Convert a heightmap PNG into the raw format. Transparent points, alpha < 0.5,
+       which are discarded by terrain_f.glsl, are written to the hole bitplane.
+    """
+    dst = os.path.splitext(src)[0] + EXTENSION if dst is None else dst
+    # read through PNMImage as assets.Heightfield does; Texture.read would rescale
+    # the image to a power of 2 unless textures-power-2 is none.
+    img = PNMImage(Filename(src))
+    tex = Texture()
+    tex.load(img)
+
+    if (tex.get_x_size(), tex.get_y_size()) != (img.get_x_size(), img.get_y_size()):
+        raise ValueError(f'{src} was resized from {img.get_x_size()}x{img.get_y_size()} on loading')
+
+    heights = texture_channel(tex)
+    holes = texture_channel(tex, 'A') < 0.5 if img.has_alpha() else None
+    write_raw(dst, heights, holes, dtype, block_size)
+    return dst
+
+
+class RawHeightfield:
+    """A heightfield file mapped into memory. Nothing but the header is read when opened;
+       the heights, the pyramid and the holes are read page by page when accessed.
+    """
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            header = f.read(HEADER.size)
+
+        magic, version, code, cols, rows, block_size, levels, data_offset, pyramid_offset, holes_offset = \
+            HEADER.unpack(header)
+
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f'{path} is not a heightfield file of version {VERSION}')
+
+        self.path = path
+        self.shape = (rows, cols)
+        self.block_size = block_size
+        self.dtype = DTYPES[code]
+        self.values = np.memmap(path, dtype=self.dtype, mode='r', offset=data_offset, shape=self.shape)
+        self.pyramid = []
+
+        blocks_y = -(-(rows - 1) // block_size)
+        blocks_x = -(-(cols - 1) // block_size)
+        pyramid = np.memmap(path, dtype='<f4', mode='r', offset=pyramid_offset,
+                            shape=(self.pyramid_size(blocks_y, blocks_x, levels),))
+        start = 0
+
+        for _ in range(levels):
+            end = start + blocks_y * blocks_x * 2
+            self.pyramid.append(pyramid[start:end].reshape(blocks_y, blocks_x, 2))
+            start = end
+            blocks_y, blocks_x = -(-blocks_y // 2), -(-blocks_x // 2)
+
+        self.hole_bits = np.memmap(path, dtype=np.uint8, mode='r', offset=holes_offset,
+                                   shape=(rows, -(-cols // 8)))
+
+    @staticmethod
+    def pyramid_size(blocks_y, blocks_x, levels):
+        size = 0
+
+        for _ in range(levels):
+            size += blocks_y * blocks_x * 2
+            blocks_y, blocks_x = -(-blocks_y // 2), -(-blocks_x // 2)
+
+        return size
+
+    def window(self, i0=0, j0=0, i1=None, j1=None):
+        rows, cols = self.shape
+        i1 = cols - 1 if i1 is None else i1
+        j1 = rows - 1 if j1 is None else j1
+        return i0, j0, i1, j1
+
+    def heights(self, i0=0, j0=0, i1=None, j1=None):
+        """Return the heights of the grid points from (i0, j0) to (i1, j1) inclusive in [0, 1]."""
+        i0, j0, i1, j1 = self.window(i0, j0, i1, j1)
+        values = self.values[j0:j1 + 1, i0:i1 + 1]
+
+        if self.dtype.kind == 'u':
+            return values.astype(np.float32) / 65535
+
+        return np.array(values, dtype=np.float32)
+
+    def holes(self, i0=0, j0=0, i1=None, j1=None):
+        """Return the hole mask of the grid points from (i0, j0) to (i1, j1) inclusive."""
+        i0, j0, i1, j1 = self.window(i0, j0, i1, j1)
+        bits = self.hole_bits[j0:j1 + 1, i0 // 8:i1 // 8 + 1]
+        return np.unpackbits(bits, axis=1)[:, i0 % 8:i0 % 8 + i1 - i0 + 1].astype(bool)
+
+    def height_range(self, i0=0, j0=0, i1=None, j1=None, level=0):
+        """Return the min and max heights of the blocks of the level overlapping the grid points
+           from (i0, j0) to (i1, j1), read from the pyramid without touching the heights.
+        """
+        i0, j0, i1, j1 = self.window(i0, j0, i1, j1)
+        size = self.block_size << level
+        blocks = self.pyramid[level][j0 // size:max(j1 - 1, j0) // size + 1, i0 // size:max(i1 - 1, i0) // size + 1]
+        return float(blocks[..., 0].min()), float(blocks[..., 1].max())
+
+    def image(self, i0=0, j0=0, i1=None, j1=None):
+        """Return the grid points from (i0, j0) to (i1, j1) as a 16 bit PNMImage for GeoMipTerrain
+           and BulletHeightfieldShape. Holes are made transparent as in the heightmap PNGs.
+        """
+        i0, j0, i1, j1 = self.window(i0, j0, i1, j1)
+        heights = np.round(self.heights(i0, j0, i1, j1) * 65535).astype(np.uint16)
+        holes = self.holes(i0, j0, i1, j1)
+
+        # texture RAM images start from the bottom row, which is the grid order.
+        tex = Texture()
+        if holes.any():
+            tex.setup_2d_texture(i1 - i0 + 1, j1 - j0 + 1, Texture.T_unsigned_short, Texture.F_luminance_alpha)
+            ram = np.stack([heights, np.where(holes, 0, 65535).astype(np.uint16)], axis=-1)
+        else:
+            tex.setup_2d_texture(i1 - i0 + 1, j1 - j0 + 1, Texture.T_unsigned_short, Texture.F_luminance)
+            ram = heights
+
+        tex.set_ram_image(np.ascontiguousarray(ram).tobytes())
+        img = PNMImage()
+        tex.store(img)
+        return img
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Convert heightmap PNGs into the raw heightfield format.')
+    parser.add_argument('files', nargs='+', help='heightmap PNGs; each is written next to it with .hfd.')
+    parser.add_argument('--dtype', default='uint16', choices=['uint16', 'float32'])
+    parser.add_argument('--block-size', type=int, default=8)
+    args = parser.parse_args()
+
+    for src in args.files:
+        print(convert_png(src, dtype=args.dtype, block_size=args.block_size))
+
+
+if __name__ == '__main__':
+    main()
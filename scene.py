@@ -1,17 +1,30 @@
-import math
+import hashlib
+import json
+import os
 import numpy as np
+from concurrent.futures import ThreadPoolExecutor
 from enum import Enum
 
 from panda3d.bullet import BulletRigidBodyNode
 from panda3d.bullet import BulletTriangleMeshShape, BulletHeightfieldShape, ZUp
 from panda3d.bullet import BulletConvexHullShape, BulletTriangleMesh
 from panda3d.core import NodePath, BitMask32, Point3, Vec3, PandaNode
-from panda3d.core import Filename, PNMImage
-from panda3d.core import Shader, TextureStage
+from panda3d.core import PNMImage
+from panda3d.core import TextureStage
 from panda3d.core import GeoMipTerrain, TransformState
+from panda3d.core import Geom, GeomNode, GeomTriangles
 from panda3d.core import TransparencyAttrib
+from panda3d.core import PTA_LVecBase2f, LVecBase2f, PTA_LVecBase3f, PTA_int
 
 from shapes import Sphere, Cylinder, Plane, Box
+from assets import asset_cache, Heightfield
+from instrumentation import timed
+from layers import LayeredWorld
+from heightfield import sample_heights, locate_triangles, grid_triangles
+from collision import BoxCollision
+from meshmerge import merge_geoms, placement_mat
+from queries import QueryService
+from spatial import GridIndex, points_in_polygon
 
 
 class Sensors(Enum):
@@ -29,6 +42,10 @@ class Sensors(Enum):
 
 class ModelRoot(NodePath):
 
+    # The models made of boxes and planes collide with box shapes instead of their triangle meshes;
+    # set False to go back to the meshes, for example to compare both by collision.py.
+    SIMPLE_COLLISION = True
+
     def __init__(self, name, mask):
         super().__init__(BulletRigidBodyNode(name))
         self.node().set_mass(0)
@@ -45,9 +62,18 @@ class ModelRoot(NodePath):
         shape.add_geom(model.node().get_geom(0))
         self.node().add_shape(shape)
 
+    def add_plane_shape(self, model):
+        """Add a thin box under the flat model, or its triangle mesh if SIMPLE_COLLISION is False."""
+        if not self.SIMPLE_COLLISION:
+            self.add_trianglemesh_shape(model)
+            return
+
+        for shape, transform in BoxCollision().create_shapes(model):
+            self.node().add_shape(shape, transform)
+
     def add_texture(self, img_file, target=None):
         target = self if not target else target
-        tex = base.loader.load_texture(f'textures/{img_file}')
+        tex = asset_cache.texture(f'textures/{img_file}')
         target.set_texture(tex)
 
 
@@ -58,6 +84,8 @@ class Sensor(ModelRoot):
         self.sensor = sensor
         self.location = sensor.location
         self.dest_sensor = None
+        # the zone of the ground where the sensor is, set by Scene.
+        self.zone = None
         self.create_model(width, depth)
         self.set_shader_off()
 
@@ -65,26 +93,26 @@ class Sensor(ModelRoot):
         model = Plane(width, depth, segs_w=int(width), segs_d=int(depth)).create()
         model.set_transparency(TransparencyAttrib.MAlpha)
         model.set_color(1, 1, 1, 0)
-        self.add_trianglemesh_shape(model)
+        self.add_plane_shape(model)
         model.reparent_to(self)
 
     def detect_collision(self, target_nd):
-        if base.world.contact_test_pair(
-                self.node(), target_nd).get_num_contacts():
+        if base.scene.queries.contact_test_pair(
+                'landing', self.node(), target_nd).get_num_contacts():
             return True
 
     def respond(self, from_pos, distance=-3):
-        to_pos = from_pos + Vec3(0, 0, distance)
-
-        if (hit := base.world.ray_test_closest(
-                from_pos, to_pos, BitMask32.bit(self.sensor.mask))).has_hit():
-            return hit
+        return base.scene.cast_down(from_pos, BitMask32.bit(self.sensor.mask), distance, 'sensor_respond')
 
 
 class WaterSurface(ModelRoot):
 
-    def __init__(self, w=256, d=256, segs_w=16, segs_d=16, mask=9):
+    def __init__(self, w=256, d=256, segs_w=16, segs_d=16, mask=9, waves=((1.0, 1.0),)):
         super().__init__('water_surface', BitMask32.bit(mask))
+        # each wave component is a pair of (wave height, speed).
+        self.waves = np.array(waves, dtype=np.float32).reshape(-1, 2)
+        self.time = 0
+        self.size = (w, d)
         self.create_model(w, d, segs_w, segs_d)
         self.set_shader_off()
 
@@ -94,62 +122,198 @@ class WaterSurface(ModelRoot):
 
         self.model = plane.create()
         self.model.set_transparency(TransparencyAttrib.MAlpha)
-        self.model.set_texture(base.loader.load_texture('textures/water.png'))
+        self.model.set_texture(asset_cache.texture('textures/water.png'))
         self.model.set_pos(Point3(0, 0, 0))
 
-        self.add_trianglemesh_shape(self.model)
+        self.add_plane_shape(self.model)
         self.model.reparent_to(self)
+        self.cache_vertices()
 
-    def wave(self, time, wave_h=1.0):
-        geom_node = self.model.node()
-        geom = geom_node.modify_geom(0)
-        vdata = geom.modify_vertex_data()
-        vdata_arr = vdata.modify_array(0)
+    def vertex_view(self):
+        geom = self.model.node().modify_geom(0)
+        vdata_arr = geom.modify_vertex_data().modify_array(0)
         vdata_mem = memoryview(vdata_arr).cast('B').cast('f')
-
-        for i in range(0, len(vdata_mem), self.stride):
-            x, y = vdata_mem[i: i + 2]
-            z = (math.sin(time + x / wave_h) + math.sin(time + y / wave_h)) * wave_h / 2
-            vdata_mem[i + 2] = z
+        return np.asarray(vdata_mem).reshape(-1, self.stride)
+
+    def cache_vertices(self):
+        # x and y never change, so divide them by the wave heights only once.
+        # They are copied because panda3d may reallocate the array on modification.
+        verts = self.vertex_view()
+        wave_h = self.waves[:, 0:1]
+        self.x_phase = verts[:, 0] / wave_h
+        self.y_phase = verts[:, 1] / wave_h
+
+    @timed('water:wave')
+    def wave(self, time):
+        self.time = time
+        wave_h = self.waves[:, 0:1]
+        t = time * self.waves[:, 1:2]
+
+        z = (np.sin(t + self.x_phase) + np.sin(t + self.y_phase)) * wave_h / 2
+        self.vertex_view()[:, 2] = z.sum(axis=0)
+
+    def height_at(self, x, y):
+        """Return the z of the water surface at the world position (x, y)
+           by the same formula as the wave animation, or None if outside the water.
+        """
+        pt = self.model.get_relative_point(base.render, Point3(x, y, 0))
+        w, d = self.size
+        if abs(pt.x) > w / 2 or abs(pt.y) > d / 2:
+            return None
+
+        wave_h = self.waves[:, 0]
+        t = self.time * self.waves[:, 1]
+        z = ((np.sin(t + pt.x / wave_h) + np.sin(t + pt.y / wave_h)) * wave_h / 2).sum()
+        return base.render.get_relative_point(self.model, Point3(pt.x, pt.y, z)).z
+
+
+class GpuWaterSurface(WaterSurface):
+    """Water surface whose vertices are displaced in the vertex shader.
+       The vertex array is never modified after creation, so the triangle mesh
+       for Bullet stays flat; use height_at to get the height of the waves.
+    """
+
+    MAX_WAVES = 8
+
+    def __init__(self, w=256, d=256, segs_w=16, segs_d=16, mask=9, waves=((1.0, 1.0),)):
+        super().__init__(w, d, segs_w, segs_d, mask, waves)
+        self.setup_shader()
+
+    def cache_vertices(self):
+        pass
+
+    def setup_shader(self):
+        waves = self.waves[:self.MAX_WAVES]
+        shader = asset_cache.shader('shaders/water_v.glsl', 'shaders/water_f.glsl')
+        self.model.set_shader(shader)
+        self.model.set_shader_input('waves', PTA_LVecBase2f([LVecBase2f(*w) for w in waves]))
+        self.model.set_shader_input('wave_count', len(waves))
+        self.model.set_shader_input('time', 0.0)
+
+    @timed('water:wave')
+    def wave(self, time):
+        self.time = time
+        self.model.set_shader_input('time', time)
 
 
 class AssembledModel(ModelRoot):
 
+    # Change the version to invalidate all the cached models,
+    # for example when the procedures to assemble models are changed.
+    CACHE_DIR = 'cache'
+    CACHE_VERSION = 5
+
     def __init__(self, name, mask):
         super().__init__(name, mask)
 
-    def setup_model(self, model, name, pos, hpr, parent=None):
-        model.set_pos_hpr(pos, hpr)
-        model.set_name(name)
+    def build(self, *params, use_cache=True):
+        """Assemble the model with the parameters, or load it and its collision
+           shapes from the bam file saved when it was assembled with the same
+           parameters before.
+        """
+        if not use_cache:
+            self.assemble_model(*params)
+            return
+
+        path = self.get_cache_path(params)
+
+        if os.path.exists(path):
+            self.load_cache(path)
+        else:
+            self.assemble_model(*params)
+            self.save_cache(path)
 
+    def get_cache_path(self, params):
+        cls_name = self.__class__.__name__
+        key = hashlib.md5(f'{self.CACHE_VERSION}:{cls_name}:{self.SIMPLE_COLLISION}:{params!r}'.encode()).hexdigest()
+        return os.path.join(self.CACHE_DIR, f'{cls_name.lower()}_{key}.bam')
+
+    def save_cache(self, path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.write_bam_file(path)
+
+    def load_cache(self, path):
+        cached = base.loader.load_model(path, noCache=True)
+        node = cached.node()
+
+        for i in range(node.get_num_shapes()):
+            self.node().add_shape(node.get_shape(i), node.get_shape_transform(i))
+
+        # textures set to the root are kept in its state.
+        self.set_state(cached.get_state())
+        cached.get_children().reparent_to(self)
+
+    def create_shape(self, model):
         mesh = BulletTriangleMesh()
         mesh.add_geom(model.node().get_geom(0))
-        shape = BulletTriangleMeshShape(mesh, dynamic=False)
-        self.node().add_shape(shape, TransformState.make_pos_hpr(pos, hpr))
+        return BulletTriangleMeshShape(mesh, dynamic=False)
+
+    def create_shapes(self, model, collision=None):
+        """Return the pairs of a collision shape and its transform in the space of the model:
+           the boxes of collision, a BoxCollision, or the triangle mesh if it is not given.
+        """
+        if collision is None or not self.SIMPLE_COLLISION:
+            return [(self.create_shape(model), TransformState.make_identity())]
+
+        return collision.create_shapes(model)
+
+    def create_box(self, **params):
+        """Return the model of Box with the params and the BoxCollision for it."""
+        return Box(**params).create(), BoxCollision.from_box(**params)
+
+    def setup_model(self, model, name, pos, hpr, parent=None, collision=None):
+        model.set_pos_hpr(pos, hpr)
+        model.set_name(name)
+        transform = TransformState.make_pos_hpr(pos, hpr)
+
+        for shape, shape_transform in self.create_shapes(model, collision):
+            self.node().add_shape(shape, transform.compose(shape_transform))
 
         parent = self if not parent else parent
         model.reparent_to(parent)
 
+    def setup_instances(self, model, name, placements, parent=None, collision=None, start=0):
+        """Place a model at each (pos, hpr) of the placements by instancing.
+           The geometry and the collision shapes are shared by all the instances,
+           which are named with the numbers from start.
+        """
+        shapes = self.create_shapes(model, collision)
+        parent = self if not parent else parent
+        model.set_name(name)
+
+        for i, (pos, hpr) in enumerate(placements, start):
+            transform = TransformState.make_pos_hpr(pos, hpr)
+
+            for shape, shape_transform in shapes:
+                self.node().add_shape(shape, transform.compose(shape_transform))
+
+            holder = parent.attach_new_node(f'{name}_{i}')
+            holder.set_pos_hpr(pos, hpr)
+            model.instance_to(holder)
+
 
 class SquareTunnel(AssembledModel):
 
     def __init__(self, mask=3):
         super().__init__('square_tunnel', BitMask32.bit(mask))
-        self.assemble_model()
+        self.build()
 
     def assemble_model(self):
         # tunnel
-        model = Box(width=4.5, depth=31, height=5, segs_w=5, segs_d=30, segs_z=5,
-                    open_bottom=True, open_front=True, open_back=True).create()
+        model, collision = self.create_box(width=4.5, depth=31, height=5, segs_w=5, segs_d=30, segs_z=5,
+                                           open_bottom=True, open_front=True, open_back=True)
         model.set_tex_scale(TextureStage.get_default(), 5, 1)
-        self.setup_model(model, 'tunnel', Point3(0.2, -0.8, -0.1), Vec3(51, 5, 0))
+        self.setup_model(model, 'tunnel', Point3(0.2, -0.8, -0.1), Vec3(51, 5, 0), collision=collision)
 
         # hollow rectangular prism that overlaps the hole in the mountain.
-        maker = Box(width=6, depth=4, height=6, segs_w=6, segs_d=4, segs_z=6,
-                    thickness=2, open_bottom=True, open_front=True, open_back=True)
+        model, collision = self.create_box(width=6, depth=4, height=6, segs_w=6, segs_d=4, segs_z=6,
+                                           thickness=2, open_bottom=True, open_front=True, open_back=True)
 
-        self.setup_model(maker.create(), 'gate_1', Point3(13.0778, -10.635, -0.5477), Vec3(64, 0, 0))
-        self.setup_model(maker.create(), 'gate_2', Point3(-10.9222, 9.36504, 1.45235), Vec3(31, 0, 0))
+        placements = [
+            (Point3(13.0778, -10.635, -0.5477), Vec3(64, 0, 0)),
+            (Point3(-10.9222, 9.36504, 1.45235), Vec3(31, 0, 0))
+        ]
+        self.setup_instances(model, 'gate', placements, collision=collision, start=1)
 
         # set texture.
         self.add_texture('tile2.jpg')
@@ -159,27 +323,27 @@ class RoundTunnel(AssembledModel):
 
     def __init__(self, mask=3):
         super().__init__('round_tunnel', BitMask32.bit(mask))
-        self.assemble_model()
+        self.build()
 
     def assemble_model(self):
         # hollow rectangular prism that overlaps the hole in the top ground.
-        model = Box(width=3, depth=3.2, height=2, segs_w=4, segs_d=4, segs_z=2,
-                    thickness=0.5, open_bottom=True, open_top=True).create()
-        self.setup_model(model, 'hole_1', Point3(0, 0, 0.1), Vec3(180, 12.6, -7.5))
+        model, collision = self.create_box(width=3, depth=3.2, height=2, segs_w=4, segs_d=4, segs_z=2,
+                                           thickness=0.5, open_bottom=True, open_top=True)
+        self.setup_model(model, 'hole_1', Point3(0, 0, 0.1), Vec3(180, 12.6, -7.5), collision=collision)
 
-        # tunnel
+        # tunnel; curved, so it collides with the triangle mesh.
         model = Cylinder(radius=1.5, height=43.5, segs_top_cap=0, segs_bottom_cap=0).create()
         self.setup_model(model, 'tunnel', Point3(0, 0, 0), Vec3(0, 180, 0))
 
         # hollow rectangular prism that overlaps the hole in the bottom ground.
-        model = Box(width=4, depth=4, height=4, segs_w=4, segs_d=4, segs_z=4,
-                    thickness=1, open_bottom=True, open_top=True).create()
-        self.setup_model(model, 'hole_2', Point3(0, 0, -42.5), Vec3(0, 0, 0))
+        model, collision = self.create_box(width=4, depth=4, height=4, segs_w=4, segs_d=4, segs_z=4,
+                                           thickness=1, open_bottom=True, open_top=True)
+        self.setup_model(model, 'hole_2', Point3(0, 0, -42.5), Vec3(0, 0, 0), collision=collision)
 
         # walls
-        model = Box(width=4, depth=4, height=6, segs_w=4, segs_d=4, segs_z=6,
-                    thickness=1, open_bottom=True, open_top=True, open_left=True, open_back=True).create()
-        self.setup_model(model, 'wall', Point3(0, 0, -47.5), Vec3(0, 0, 0))
+        model, collision = self.create_box(width=4, depth=4, height=6, segs_w=4, segs_d=4, segs_z=6, thickness=1,
+                                           open_bottom=True, open_top=True, open_left=True, open_back=True)
+        self.setup_model(model, 'wall', Point3(0, 0, -47.5), Vec3(0, 0, 0), collision=collision)
 
         # set texture.
         self.add_texture('metalboard.jpg')
@@ -189,8 +353,15 @@ class Basement(AssembledModel):
 
     def __init__(self):
         super().__init__('underground_room', BitMask32.bit(3))
-        self.assemble_model()
-        self.flatten_strong()
+        self.build()
+
+        # room camera
+        self.room_camera = NodePath('underground_room_camera')
+        self.room_camera.reparent_to(self)
+        self.room_camera.set_pos(Point3(-4.5, -4.5, -2))
+
+        # flattening the steps would make copies of the instanced step.
+        self.find('room').flatten_strong()
 
     def assemble_model(self):
         basement = NodePath('room')
@@ -199,47 +370,39 @@ class Basement(AssembledModel):
         steps.reparent_to(self)
 
         # hollow rectangular prism that overlaps the hole.
-        model = Box(width=5, depth=5, height=2, segs_w=3, segs_d=3, thickness=1.0,
-                    open_bottom=True, open_top=True).create()
-        self.setup_model(model, 'hole', Point3(0, 0, 0), Vec3(180, 0, 0), basement)
+        model, collision = self.create_box(width=5, depth=5, height=2, segs_w=3, segs_d=3, thickness=1.0,
+                                           open_bottom=True, open_top=True)
+        self.setup_model(model, 'hole', Point3(0, 0, 0), Vec3(180, 0, 0), basement, collision)
 
         # room
-        model = Box(width=13.5, depth=13.5, height=8, segs_w=5, segs_d=5, segs_z=8, thickness=0.5,
-                    open_top=True).create()
-        self.setup_model(model, 'room', Point3(-4.5, -4.5, -5), Vec3(180, 0, 0), basement)
-
-        # roofs
-        model = Box(width=9, depth=13.5, height=0.5, segs_w=9, segs_d=5, thickness=0.5, open_top=True).create()
-        self.setup_model(model, 'roof_1', Point3(-6.75, -4.5, -0.75), Vec3(0, 0, 0), parent=basement)
-        model = Box(width=4.5, depth=9, height=0.5, segs_w=3, segs_d=9, thickness=0.5, open_top=True).create()
-        self.setup_model(model, 'roof_2', Point3(0, -6.75, -0.75), Vec3(0, 0, 0), parent=basement)
+        model, collision = self.create_box(width=13.5, depth=13.5, height=8, segs_w=5, segs_d=5, segs_z=8,
+                                           thickness=0.5, open_top=True)
+        self.setup_model(model, 'room', Point3(-4.5, -4.5, -5), Vec3(180, 0, 0), basement, collision)
+
+        # roofs; the thickness fills them, so each collides with one box.
+        model, collision = self.create_box(width=9, depth=13.5, height=0.5, segs_w=9, segs_d=5,
+                                           thickness=0.5, open_top=True)
+        self.setup_model(model, 'roof_1', Point3(-6.75, -4.5, -0.75), Vec3(0, 0, 0), basement, collision)
+        model, collision = self.create_box(width=4.5, depth=9, height=0.5, segs_w=3, segs_d=9,
+                                           thickness=0.5, open_top=True)
+        self.setup_model(model, 'roof_2', Point3(0, -6.75, -0.75), Vec3(0, 0, 0), basement, collision)
 
         # steps
-        maker = Box(width=3.5, depth=1, height=1.5)
+        model, collision = self.create_box(width=3.5, depth=1, height=1.5)
         start_z, start_y = -1.25, 1.25
-        hpr = Vec3(0, 0, 0)
-
-        for i in range(6):
-            model = maker.create()
-            pos = Point3(0, start_y - i, start_z - i * 1.5)
-            name = f'steps_{i}'
-            self.setup_model(model, name, pos, hpr, parent=steps)
+        placements = [(Point3(0, start_y - i, start_z - i * 1.5), Vec3(0, 0, 0)) for i in range(6)]
+        self.setup_instances(model, 'steps', placements, parent=steps, collision=collision)
 
         # set_texture
         for img_file, target in [('tile2.jpg', basement), ('concrete_01.jpg', steps)]:
             self.add_texture(img_file, target)
 
-        # room camera
-        self.room_camera = NodePath('underground_room_camera')
-        self.room_camera.reparent_to(self)
-        self.room_camera.set_pos(Point3(-4.5, -4.5, -2))
-
 
 class Cave(AssembledModel):
 
     def __init__(self, width, depth, wall_height, thickness, mask=3):
         super().__init__('cave', BitMask32.bit(mask))
-        self.assemble_model(width, depth, wall_height, thickness)
+        self.build(width, depth, wall_height, thickness)
 
     def create_model(self, width, depth, wall_height, thickness):
         # side walls
@@ -268,18 +431,10 @@ class Cave(AssembledModel):
 
         # cave wall
         base_nd = maker.get_geom_node()
-
-        for parts_maker, axis_vec, bottom_center, rotation_deg in parts:
-            geom_nd = parts_maker.get_geom_node()
-            geom = geom_nd.modify_geom(0)
-            vdata = geom.modify_vertex_data()
-            maker.tranform_vertices(vdata, axis_vec, bottom_center, rotation_deg)
-            vert_cnt = vdata.get_num_rows()
-            vdata_mem = memoryview(vdata.modify_array(0)).cast('B').cast('f')
-            prim = geom.modify_primitive(0)
-            prim_array = prim.modify_vertices()
-            prim_mem = memoryview(prim_array).cast('B').cast('H')
-            maker.add(base_nd, vdata_mem, vert_cnt, prim_mem)
+        merge_geoms(base_nd, [
+            (parts_maker.get_geom_node(), placement_mat(axis_vec, bottom_center, rotation_deg))
+            for parts_maker, axis_vec, bottom_center, rotation_deg in parts
+        ])
 
         model = maker.modeling(base_nd)
         return model
@@ -290,52 +445,270 @@ class Cave(AssembledModel):
         gate = NodePath('gate')
         gate.reparent_to(self)
 
-        # cave
+        # cave; curved, so it collides with the triangle mesh.
         model = self.create_model(width, depth, wall_height, thickness)
         self.setup_model(model, 'cave', Point3(0, 0, 0), Vec3(0, 0, 0), parent=cave)
 
         # gate
         w = width + 2
         h = wall_height + 5
-        model = Box(width=w, depth=6, height=h, segs_w=int(w), segs_d=6, segs_z=int(h),
-                    thickness=2, open_bottom=True, open_front=True, open_back=True).create()
+        model, collision = self.create_box(width=w, depth=6, height=h, segs_w=int(w), segs_d=6, segs_z=int(h),
+                                           thickness=2, open_bottom=True, open_front=True, open_back=True)
 
         pos = Point3(0, -depth / 2 + 3.1, 2)
-        self.setup_model(model, 'gate', pos, Vec3(0, 0, 0), parent=gate)
+        self.setup_model(model, 'gate', pos, Vec3(0, 0, 0), gate, collision)
 
         for img_file, target in [('concrete_01.jpg', cave), ('tile2.jpg', gate)]:
             self.add_texture(img_file, target)
 
 
+MODEL_TYPES = {
+    'SquareTunnel': SquareTunnel,
+    'RoundTunnel': RoundTunnel,
+    'Basement': Basement,
+    'Cave': Cave,
+    'WaterSurface': WaterSurface,
+}
+
+
+def read_description(path):
+    """Read a scene file. If it has "extends", the file of the path relative to it
+       is read first, and the lists of the scene file are added after the lists of that file.
+    """
+    with open(path) as f:
+        description = json.load(f)
+
+    if not (base_path := description.pop('extends', None)):
+        return description
+
+    base = read_description(os.path.join(os.path.dirname(path), base_path))
+
+    for key, items in description.items():
+        base[key] = base.get(key, []) + items
+
+    return base
+
+
+class Lod:
+    """Level of detail of a terrain. Blocks within near from the focal point are drawn
+       at min_level and blocks beyond far at the lowest level, log2 of the block size;
+       factor, if given, is used instead of near and far. The levels are updated only
+       after the focal point moves more than threshold.
+    """
+
+    def __init__(self, near=16, far=128, factor=None, threshold=2, min_level=0):
+        self.near = near
+        self.far = far
+        self.min_level = min_level
+        self.factor = factor
+        self.threshold = threshold
+
+
 class Terrain(NodePath):
 
-    def __init__(self, name, heightmap, height, tex_files, block_size=8, mask=1, discard=True):
+    TILE_SIZE = 16
+
+    def __init__(self, name, heightmap, height, tex_files, block_size=8, mask=1, discard=True, lod=None):
         super().__init__(BulletRigidBodyNode(f'terrain_{name}'))
-        self.heightmap = f'terrains/{heightmap}'
         self.height = height
         self.block_size = block_size
         self.discard = discard
 
+        # Without lod, all the blocks are drawn at the min level.
+        self.lod = lod
+        self.focal_pos = None
+        self.block_geoms = {}
+
+        # The heightmap is decoded only once and shared by the shape, GeoMipTerrain and the shader.
+        # Create the shape from PNMImage, not Texture, to get the same heights as GeoMipTerrain.
+        # heightmap is a file name in terrains or a Heightfield created in memory, like a streamed tile.
+        if isinstance(heightmap, Heightfield):
+            self.heightfield = heightmap
+        else:
+            self.heightfield = asset_cache.heightfield(f'terrains/{heightmap}')
+        self.img = self.heightfield.img
+        self.heights = self.heightfield.heights
+        self.hole_mask = np.zeros(self.heights.shape, dtype=bool)
+        self.holes = []
+
         self.node().set_mass(0)
         self.set_collide_mask(BitMask32.bit(mask))
-        shape = BulletHeightfieldShape(base.loader.load_texture(self.heightmap), self.height, ZUp)
-        shape.set_use_diamond_subdivision(True)
-        self.node().add_shape(shape)
+        self.shape = BulletHeightfieldShape(self.img, self.height, ZUp)
+        self.shape.set_use_diamond_subdivision(True)
+        self.node().add_shape(self.shape)
         self.generate_terrain(tex_files)
 
+        # triangles of the collision shape which are removed for holes.
+        rows, cols = self.heights.shape
+        self.removed = np.zeros((rows - 1, cols - 1, 2), dtype=bool)
+        self.tiles = None
+
+        # transparent parts of the heightmap are discarded in the shader.
+        if self.discard and self.heightfield.alpha is not None:
+            alpha_holes = self.heightfield.alpha < 0.5
+            self.remove_triangles(0, 0, cols - 1, rows - 1, lambda i, j: alpha_holes[j, i].all(axis=-1))
+
         self.name = name
 
+    def height_at(self, x, y):
+        """Return the z of the terrain surface at the world position (x, y),
+           or None if the position is outside the terrain or in a hole.
+        """
+        pt = self.get_relative_point(base.render, Point3(x, y, 0))
+        rows, cols = self.heights.shape
+        gx = pt.x + (cols - 1) / 2
+        gy = pt.y + (rows - 1) / 2
+        h = sample_heights(self.heights, gx, gy)
+
+        if np.isnan(h):
+            return None
+
+        i, j, k, _, _ = locate_triangles(self.heights, gx, gy)
+        if self.removed[j, i, k]:
+            return None
+
+        z = h * self.height - self.height / 2
+        return base.render.get_relative_point(self, Point3(pt.x, pt.y, z)).z
+
+    def heights_at(self, x, y):
+        """Array version of height_at for the world positions in the arrays x and y.
+           nan is returned where height_at returns None.
+        """
+        x = np.asarray(x, dtype=np.float32)
+        y = np.asarray(y, dtype=np.float32)
+        pts = np.stack([x, y, np.zeros_like(x), np.ones_like(x)], axis=-1)
+
+        # matrices of Panda3D transform row vectors.
+        pts = pts @ np.array(base.render.get_mat(self), dtype=np.float32)
+        rows, cols = self.heights.shape
+        gx = pts[..., 0] + (cols - 1) / 2
+        gy = pts[..., 1] + (rows - 1) / 2
+        h = sample_heights(self.heights, gx, gy)
+
+        i, j, k, _, _ = locate_triangles(self.heights, gx, gy)
+        h = np.where(self.removed[j, i, k], np.nan, h)
+
+        pts[..., 2] = h * self.height - self.height / 2
+        return (pts @ np.array(self.get_mat(base.render), dtype=np.float32))[..., 2]
+
+    def hole_near(self, x, y, margin=2):
+        """Return True if any triangle within the margin from the world position (x, y)
+           is removed for a hole.
+        """
+        if self.tiles is None:
+            return False
+
+        pt = self.get_relative_point(base.render, Point3(x, y, 0))
+        rows, cols = self.heights.shape
+        gx = pt.x + (cols - 1) / 2
+        gy = pt.y + (rows - 1) / 2
+        i0, i1 = max(int(gx - margin), 0), min(int(gx + margin) + 1, cols - 1)
+        j0, j1 = max(int(gy - margin), 0), min(int(gy + margin) + 1, rows - 1)
+        return i0 < i1 and j0 < j1 and self.removed[j0:j1, i0:i1].any()
+
+    def remove_triangles(self, i0, j0, i1, j1, is_removed):
+        """Remove the triangles for which is_removed returns True from the collision shape
+           in the cells from (i0, j0) to (i1, j1) exclusive. is_removed is called with the
+           grid coordinates of the triangle corners, i and j, of shape (rows, cols, 2, 3).
+        """
+        if tiles := self.mark_triangles(i0, j0, i1, j1, is_removed):
+            self.update_collision(tiles)
+
+    def mark_triangles(self, i0, j0, i1, j1, is_removed):
+        """Mark the triangles to be removed like remove_triangles without updating
+           the collision shape. Returns the set of the tiles with new removed triangles.
+        """
+        corners = grid_triangles(i0, j0, i1, j1)
+        removed = is_removed(corners[..., 0], corners[..., 1]) & ~self.removed[j0:j1, i0:i1]
+
+        if not removed.any():
+            return set()
+
+        self.removed[j0:j1, i0:i1] |= removed
+        j, i, _ = np.nonzero(removed)
+        return set(zip(((i0 + i) // self.TILE_SIZE).tolist(), ((j0 + j) // self.TILE_SIZE).tolist()))
+
+    def split_collision(self):
+        """Replace the heightfield shape with tiles, so that the tiles with holes
+           can be rebuilt individually.
+        """
+        rows, cols = self.heights.shape
+        self.node().remove_shape(self.shape)
+        self.tiles = {}
+
+        for ty in range(0, (rows - 2) // self.TILE_SIZE + 1):
+            for tx in range(0, (cols - 2) // self.TILE_SIZE + 1):
+                self.add_tile(tx, ty)
+
+    def add_tile(self, tx, ty):
+        rows, cols = self.heights.shape
+        i0, j0 = tx * self.TILE_SIZE, ty * self.TILE_SIZE
+        i1, j1 = min(i0 + self.TILE_SIZE, cols - 1), min(j0 + self.TILE_SIZE, rows - 1)
+
+        if (removed := self.removed[j0:j1, i0:i1]).any():
+            shape = self.create_tile_mesh(i0, j0, i1, j1, removed)
+            ts = TransformState.make_identity()
+        else:
+            # the image rows are upside down against the grid.
+            img = PNMImage(i1 - i0 + 1, j1 - j0 + 1, self.img.get_num_channels(), self.img.get_maxval())
+            img.copy_sub_image(self.img, 0, 0, i0, rows - 1 - j1, i1 - i0 + 1, j1 - j0 + 1)
+            shape = BulletHeightfieldShape(img, self.height, ZUp)
+            shape.set_use_diamond_subdivision(True)
+            center = Point3((i0 + i1 - cols + 1) / 2, (j0 + j1 - rows + 1) / 2, 0)
+            ts = TransformState.make_pos(center)
+
+        self.node().add_shape(shape, ts)
+        self.tiles[(tx, ty)] = shape
+
+    def create_tile_mesh(self, i0, j0, i1, j1, removed):
+        rows, cols = self.heights.shape
+        corners = grid_triangles(i0, j0, i1, j1)[~removed].reshape(-1, 2)
+
+        pts = PTA_LVecBase3f.empty_array(len(corners))
+        points = np.frombuffer(memoryview(pts), dtype=np.float32).reshape(-1, 3)
+        points[:, 0] = corners[:, 0] - (cols - 1) / 2
+        points[:, 1] = corners[:, 1] - (rows - 1) / 2
+        points[:, 2] = self.heights[corners[:, 1], corners[:, 0]] * self.height - self.height / 2
+
+        indices = PTA_int.empty_array(len(corners))
+        np.frombuffer(memoryview(indices), dtype=np.int32)[:] = np.arange(len(corners))
+
+        mesh = BulletTriangleMesh()
+        mesh.add_array(pts, indices, True)
+        return BulletTriangleMeshShape(mesh, dynamic=False)
+
+    def update_collision(self, tiles):
+        if self.tiles is None:
+            self.split_collision()
+        else:
+            for tx, ty in tiles:
+                self.node().remove_shape(self.tiles.pop((tx, ty)))
+                self.add_tile(tx, ty)
+
+        # the proxies in the zone worlds still have the old shapes, if the terrain is attached.
+        if (scene := getattr(base, 'scene', None)) is not None:
+            scene.layers.refresh(self)
+
     def generate_terrain(self, tex_files):
-        img = PNMImage(Filename(self.heightmap))
         self.terrain = GeoMipTerrain('geomip_terrain')
-        self.terrain.set_heightfield(self.heightmap)
+        self.terrain.set_heightfield(self.img)
         self.terrain.set_border_stitching(True)
         self.terrain.set_block_size(self.block_size)
-        self.terrain.set_min_level(2)
         self.terrain.set_focal_point(base.camera)
-        self.terrain.setBruteforce("True")
 
-        size_x, size_y = img.get_size()
+        if self.lod is None:
+            self.terrain.set_min_level(2)
+            self.terrain.set_bruteforce(True)
+        else:
+            # with 8-cell blocks, min level 0 gives the four levels 0 to 3 between near
+            # and far; min level 2 would leave only two.
+            self.terrain.set_min_level(self.lod.min_level)
+            if self.lod.factor is not None:
+                self.terrain.set_factor(self.lod.factor)
+            else:
+                self.terrain.set_near_far(self.lod.near, self.lod.far)
+
+        size_x, size_y = self.img.get_size()
         x = (size_x - 1) / 2
         y = (size_y - 1) / 2
         # x = size_x / 2 - 0.4
@@ -348,17 +721,23 @@ class Terrain(NodePath):
         self.terrain.generate()
         self.root.reparent_to(self)
 
-        f_name = 'terrain_f' if self.discard else 'terrain_no_discard_f'
-        shader = Shader.load(Shader.SL_GLSL, 'shaders/terrain_v.glsl', f'shaders/{f_name}.glsl')
+        # discard is used only for the triangles on the borders of holes; see mask_block.
+        shader = asset_cache.shader('shaders/terrain_v.glsl', 'shaders/terrain_no_discard_f.glsl')
         self.root.set_shader(shader)
-        if self.discard:
-            self.root.set_shader_input('heightmap', base.loader.load_texture(self.heightmap))
+        self.hole_table = None
+        if self.discard and self.heightfield.alpha is not None:
+            self.setup_hole_mask()
+
+        rows, cols = self.heights.shape
+        for mx in range((cols - 1) // self.block_size):
+            for my in range((rows - 1) // self.block_size):
+                self.refresh_block(mx, my)
 
         for i, (file_name, tex_scale) in enumerate(tex_files):
             ts = TextureStage(f'ts{i}')
             ts.set_sort(i)
             self.root.set_shader_input(f'tex_ScaleFactor{i}', tex_scale)
-            tex = base.loader.load_texture(f'textures/{file_name}')
+            tex = asset_cache.texture(f'textures/{file_name}')
             self.root.set_texture(ts, tex)
 
     def make_hole(self, mx, my):
@@ -373,6 +752,198 @@ class Terrain(NodePath):
         view = memoryview(v_array).cast('B').cast('f')
         view[:] = np.zeros(len(view), dtype=np.float32)
 
+    def to_grid(self, polygon):
+        """Convert a polygon in world coordinates into heightfield grid coordinates."""
+        rows, cols = self.heights.shape
+        offset = np.array([(cols - 1) / 2, (rows - 1) / 2])
+        mat = self.get_net_transform().get_inverse().get_mat()
+        pts = [mat.xform_point(Point3(x, y, 0)) for x, y in polygon]
+        return np.array([(pt.x, pt.y) for pt in pts]) + offset
+
+    def carve_holes(self, polygons):
+        """Remove the triangles whose centroids are inside any of the polygons,
+           which are sequences of (x, y) in world coordinates, from the blocks
+           and from the collision shape.
+           Returns the mask of the heightfield grid points inside the polygons.
+        """
+        grid_polygons = [self.to_grid(polygon) for polygon in polygons]
+        self.holes.extend(grid_polygons)
+        rows, cols = self.heights.shape
+        blocks_x = (cols - 1) // self.block_size
+        blocks_y = (rows - 1) // self.block_size
+
+        # collect polygons for each block to carve a block only once.
+        block_polygons = {}
+
+        for polygon in grid_polygons:
+            min_x, min_y = (polygon.min(axis=0) // self.block_size).astype(int)
+            max_x, max_y = (polygon.max(axis=0) // self.block_size).astype(int)
+
+            for mx in range(max(min_x, 0), min(max_x, blocks_x - 1) + 1):
+                for my in range(max(min_y, 0), min(max_y, blocks_y - 1) + 1):
+                    block_polygons.setdefault((mx, my), []).append(polygon)
+
+        for (mx, my), polygons in block_polygons.items():
+            self.carve_block(mx, my, polygons)
+
+        # mark the triangles of all the polygons, and then rebuild the collision shape only once.
+        tiles = set()
+
+        for polygon in grid_polygons:
+            i0, j0 = np.clip(np.floor(polygon.min(axis=0)).astype(int), 0, (cols - 1, rows - 1))
+            i1, j1 = np.clip(np.ceil(polygon.max(axis=0)).astype(int), 0, (cols - 1, rows - 1))
+            tiles |= self.mark_triangles(
+                i0, j0, i1, j1,
+                lambda i, j: points_in_polygon(i.mean(axis=-1), j.mean(axis=-1), polygon)
+            )
+
+        if tiles:
+            self.update_collision(tiles)
+
+        mask = np.zeros(self.heights.shape, dtype=bool)
+        gy, gx = np.mgrid[0:rows, 0:cols]
+
+        for polygon in grid_polygons:
+            mask |= points_in_polygon(gx, gy, polygon)
+
+        self.hole_mask |= mask
+        return mask
+
+    def get_triangles(self, block_np, geom):
+        """Return the grid coordinates of the triangle corners of a block geom, of shape (n, 3, 2),
+           the triangles as an array of indices of shape (n, 3), and the index array of the primitive.
+        """
+        geom.decompose_in_place()
+
+        prim = geom.modify_primitive(0)
+        index_type = {1: np.uint8, 2: np.uint16, 4: np.uint32}[prim.get_index_stride()]
+        prim_array = prim.modify_vertices()
+        tris = np.frombuffer(memoryview(prim_array), dtype=index_type).reshape(-1, 3)
+
+        # the vertices of a block are relative to the block center in grid coordinates.
+        # Vertices which are not used at the current level are left uninitialized.
+        vdata = geom.get_vertex_data()
+        stride = vdata.get_format().get_array(0).get_stride() // 4
+        verts = np.frombuffer(memoryview(vdata.get_array(0)), dtype=np.float32).reshape(-1, stride)
+        corners = verts[tris, :2] + np.array([block_np.get_x(), block_np.get_y()], dtype=np.float32)
+        return corners, tris, prim_array
+
+    def set_triangles(self, prim_array, tris):
+        prim_array.unclean_set_num_rows(tris.size)
+        np.frombuffer(memoryview(prim_array), dtype=tris.dtype)[:] = tris.ravel()
+
+    def setup_hole_mask(self):
+        """Prepare a summed-area table of the holes of the heightmap alpha, to count
+           the hole points in the bounding box of a triangle in constant time.
+        """
+        rows, cols = self.heights.shape
+        holes = self.heightfield.alpha < 0.5
+        self.hole_table = np.zeros((rows + 1, cols + 1), dtype=np.int32)
+        self.hole_table[1:, 1:] = holes.cumsum(axis=0).cumsum(axis=1)
+        self.border_shader = asset_cache.shader('shaders/terrain_v.glsl', 'shaders/terrain_f.glsl')
+
+    def mask_block(self, mx, my):
+        """Drop the triangles inside the holes of the heightmap alpha from the block, and
+           move the triangles on the borders of the holes to a child node drawn with the
+           discard shader, so that the rest of the terrain keeps early-Z.
+        """
+        rows, cols = self.heights.shape
+        table = self.hole_table
+        x0, y0 = mx * self.block_size, my * self.block_size
+        x1, y1 = min(x0 + self.block_size, cols - 1) + 1, min(y0 + self.block_size, rows - 1) + 1
+
+        if table[y1, x1] - table[y0, x1] - table[y1, x0] + table[y0, x0] == 0:
+            return
+
+        block_np = self.terrain.get_block_node_path(mx, my)
+        geom = block_np.node().modify_geom(0)
+        corners, tris, prim_array = self.get_triangles(block_np, geom)
+        min_pt = np.floor(corners.min(axis=1)).astype(np.int32)
+        max_pt = np.ceil(corners.max(axis=1)).astype(np.int32)
+
+        i0, i1 = np.clip(min_pt[:, 0], 0, cols - 1), np.clip(max_pt[:, 0], 0, cols - 1) + 1
+        j0, j1 = np.clip(min_pt[:, 1], 0, rows - 1), np.clip(max_pt[:, 1], 0, rows - 1) + 1
+        count = table[j1, i1] - table[j0, i1] - table[j1, i0] + table[j0, i0]
+
+        if not count.any():
+            return
+
+        border = (count > 0) & (count < (i1 - i0) * (j1 - j0))
+        border_tris = tris[border].copy()
+        self.set_triangles(prim_array, tris[count == 0].copy())
+
+        if len(border_tris):
+            prim = GeomTriangles(Geom.UH_static)
+            prim.set_index_type(geom.get_primitive(0).get_index_type())
+            self.set_triangles(prim.modify_vertices(), border_tris)
+            border_geom = Geom(geom.get_vertex_data())
+            border_geom.add_primitive(prim)
+
+            node = GeomNode('hole_border')
+            node.add_geom(border_geom, block_np.node().get_geom_state(0))
+            border_np = block_np.attach_new_node(node)
+            border_np.set_shader(self.border_shader)
+            border_np.set_shader_input('heightmap', self.heightfield.texture)
+
+    def block_holes(self, mx, my):
+        """Return the carved polygons overlapping the block."""
+        x0, y0 = mx * self.block_size, my * self.block_size
+        x1, y1 = x0 + self.block_size, y0 + self.block_size
+
+        return [polygon for polygon in self.holes
+                if (polygon.min(axis=0) <= (x1, y1)).all() and (polygon.max(axis=0) >= (x0, y0)).all()]
+
+    def refresh_block(self, mx, my):
+        """Apply the holes to the geometry of a block, which is created again when its level changes."""
+        block_np = self.terrain.get_block_node_path(mx, my)
+        block_np.find_all_matches('hole_border').detach()
+
+        if self.hole_table is not None:
+            self.mask_block(mx, my)
+        if polygons := self.block_holes(mx, my):
+            self.carve_block(mx, my, polygons)
+
+        self.block_geoms[(mx, my)] = block_np.node().get_geom(0).this
+
+    def update_lod(self):
+        """Update the levels of the blocks if the focal point has moved more than the threshold,
+           and apply the holes to the blocks whose geometry is created again.
+        """
+        pos = self.terrain.get_focal_point().get_pos(base.render)
+
+        if self.focal_pos is not None and (pos - self.focal_pos).length() < self.lod.threshold:
+            return False
+
+        self.focal_pos = pos
+        if not self.terrain.update():
+            return False
+
+        rows, cols = self.heights.shape
+        for mx in range((cols - 1) // self.block_size):
+            for my in range((rows - 1) // self.block_size):
+                if self.terrain.get_block_node_path(mx, my).node().get_geom(0).this != self.block_geoms[(mx, my)]:
+                    self.refresh_block(mx, my)
+
+        return True
+
+    def carve_block(self, mx, my, polygons):
+        block_np = self.terrain.get_block_node_path(mx, my)
+
+        # a block may have a child for the triangles on the borders of alpha holes.
+        for geom_np in [block_np, *block_np.find_all_matches('hole_border')]:
+            geom = geom_np.node().modify_geom(0)
+            corners, tris, prim_array = self.get_triangles(block_np, geom)
+            cx, cy = corners.mean(axis=1).T
+            covered = np.zeros(len(tris), dtype=bool)
+
+            for polygon in polygons:
+                covered |= points_in_polygon(cx, cy, polygon)
+
+            if covered.any():
+                self.set_triangles(prim_array, tris[~covered].copy())
+
+        self.block_geoms[(mx, my)] = block_np.node().get_geom(0).this
+
 
 class Sky(NodePath):
 
@@ -384,129 +955,377 @@ class Sky(NodePath):
         self.model = None
 
 
+class GroundHit:
+    """Hit result of a downward query answered from a terrain heightfield.
+       It has the same interface as BulletClosestHitRayResult for the callers.
+    """
+
+    def __init__(self, node, hit_pos):
+        self.node = node
+        self.hit_pos = hit_pos
+
+    def has_hit(self):
+        return True
+
+    def get_node(self):
+        return self.node
+
+    def get_hit_pos(self):
+        return self.hit_pos
+
+
 class Scene:
 
-    def __init__(self):
+    # the bounds of the models not given in the scene files, saved when the models are built.
+    BOUNDS_FILE = os.path.join(AssembledModel.CACHE_DIR, 'bounds.json')
+
+    def __init__(self, path='scenes/default.json', gpu_water=True, lazy=True, load_radius=30,
+                 workers=0, progress=None):
+        """workers is the number of threads to make the objects on; they are made on this thread if 0.
+           progress is called with the number of the objects added, the total and the name of the object.
+        """
+        self.gpu_water = gpu_water
+        self.lazy = lazy
+        self.load_radius = load_radius
+        self.workers = workers
+        self.progress = progress
         self.root = NodePath('scene')
-        self.create_terrains()
-        self.setup_environments()
-        self.create_sensor()
+        self.layers = LayeredWorld()
+        self.queries = QueryService(self.layers)
+        self.natures = []
+        self.streams = []
+        self.pending = []
+        self.sensors = {}
+        self.sensor_dests = {}
+        # counted up when the indices change, for the users which copy them.
+        self.revision = 0
 
-    def attach_nature(self, model, parent=None):
+        self.sky = Sky()
+        self.sky.reparent_to(self.root)
+        self.load_description(path)
+        self.setup_ground_query()
+
+    def attach_nature(self, model, parent=None, zones=None):
+        """Attach the model to base.world and to the layers of the zones; to all of them if zones is None."""
         parent = self.root if parent is None else parent
         model.reparent_to(parent)
         base.world.attach(model.node())
+        self.layers.attach(model, zones)
+        self.natures.append(model)
+
+        if isinstance(model, Sensor):
+            model.zone = self.layers.zone_of(model.node())
+
+    def detach_nature(self, model):
+        """Remove the model attached by attach_nature, also from the ground query indices."""
+        base.world.remove(model.node())
+        self.layers.remove(model)
+        self.natures.remove(model)
+        self.unindex_nature(model)
+        model.detach_node()
+
+    def setup_ground_query(self, margin=0.5):
+        """Split the collision objects into terrains, whose heights can be
+           calculated from heightmaps, and the others, which need ray tests.
+           The bounding boxes of the others are indexed to skip needless ray tests.
+        """
+        self.terrains = []
+        self.waters = []
+        self.terrain_mask = BitMask32.all_off()
+        self.model_index = GridIndex()
+        self.sensor_index = GridIndex(cell_size=4)
+        self.index_margin = Vec3(margin, margin, margin)
+
+        for model in self.natures:
+            self.index_nature(model)
+
+    def index_nature(self, model):
+        """Add the model to the ground query indices. Models attached after
+           setup_ground_query, like streamed terrain tiles, must be added by this.
+        """
+        self.revision += 1
+
+        if isinstance(model, Terrain):
+            self.terrains.append(model)
+            self.terrain_mask |= model.get_collide_mask()
+            return
+
+        # The collision shape of the water is flat, so the heights of the waves are calculated too.
+        if isinstance(model, WaterSurface):
+            self.waters.append(model)
+            self.terrain_mask |= model.get_collide_mask()
+            return
+
+        if (bounds := model.get_tight_bounds(self.root)) is None:
+            return
+
+        min_pt, max_pt = bounds
+        self.model_index.insert(model, min_pt - self.index_margin, max_pt + self.index_margin)
+
+        if isinstance(model, Sensor):
+            self.sensor_index.insert(model, min_pt - self.index_margin, max_pt + self.index_margin)
+
+    def unindex_nature(self, model):
+        self.revision += 1
+
+        if isinstance(model, (Terrain, WaterSurface)):
+            (self.terrains if isinstance(model, Terrain) else self.waters).remove(model)
+            self.terrain_mask = BitMask32.all_off()
+            for surface in self.terrains + self.waters:
+                self.terrain_mask |= surface.get_collide_mask()
+            return
+
+        self.model_index.remove(model)
+
+        if isinstance(model, Sensor):
+            self.sensor_index.remove(model)
+
+    def add_stream(self, stream):
+        """Add an object, like TiledTerrain, whose update is called with the walker position every frame."""
+        self.streams.append(stream)
+
+    def load_streams(self, pos):
+        """Load the streamed objects around pos at once, before the walker is put there."""
+        for stream in self.streams:
+            stream.update(pos, wait=True)
+
+    def update(self, pos):
+        if self.pending:
+            self.load_near(pos)
+
+        for stream in self.streams:
+            stream.update(pos)
+
+        for terrain in self.terrains:
+            if terrain.lod is not None:
+                terrain.update_lod()
+
+    def may_hit_models(self, from_pos, to_pos, mask):
+        bottom = min(from_pos.z, to_pos.z)
+        top = max(from_pos.z, to_pos.z)
+
+        return any(not (model.get_collide_mask() & mask).is_zero()
+                   for model in self.model_index.query(from_pos.x, from_pos.y, bottom, top))
+
+    def over_hole(self, pos):
+        return any(terrain.hole_near(pos.x, pos.y) for terrain in self.terrains)
+
+    def zone_below(self, pos):
+        """Return the zone of the ground below pos, for the walker put there directly."""
+        if hit := self.cast_down(pos, BitMask32.bit(1), -100):
+            return self.layers.zone_of(hit.get_node())
+        return None
+
+    def cast_down(self, from_pos, mask, distance, category='ground'):
+        """Find the closest ground below from_pos within the distance.
+           The heights of terrains are calculated from their heightmaps and those of
+           the water from its waves, and ray test is used only if the other objects can be hit.
+        """
+        to_pos = from_pos + Vec3(0, 0, distance)
+        hit = None
+
+        for surface in self.terrains + self.waters:
+            if (surface.get_collide_mask() & mask).is_zero():
+                continue
+            if (z := surface.height_at(from_pos.x, from_pos.y)) is not None \
+                    and to_pos.z <= z <= from_pos.z:
+                if hit is None or z > hit.get_hit_pos().z:
+                    hit = GroundHit(surface.node(), Point3(from_pos.x, from_pos.y, z))
+
+        if not (model_mask := mask & ~self.terrain_mask).is_zero() \
+                and self.may_hit_models(from_pos, to_pos, model_mask):
+            if (result := self.queries.ray_test(category, from_pos, to_pos, model_mask)).has_hit():
+                if hit is None or result.get_hit_pos().z > hit.get_hit_pos().z:
+                    hit = result
+
+        return hit
+
+    def load_description(self, path):
+        """Build the objects described in the scene file. Terrains and sensors are built
+           now; models with bounds are built when the walker comes near them, if lazy.
+           The bounds of a model can be left out; then they are taken from the model
+           built before, or the model is built now and its bounds are saved.
+        """
+        description = read_description(path)
+        saved_bounds = self.read_bounds()
+        unbounded = []
+        jobs = [(self.make_terrain, spec) for spec in description.get('terrains', [])]
+
+        for spec in description.get('models', []):
+            if 'bounds' not in spec:
+                if (bounds := saved_bounds.get(self.bounds_key(spec))) is None:
+                    unbounded.append(spec)
+                else:
+                    spec = {**spec, 'bounds': bounds}
+
+            if self.lazy and 'bounds' in spec:
+                setattr(self, spec['attr'], None)
+                self.pending.append(spec)
+            else:
+                jobs.append((self.make_model, spec))
+
+        for i, spec in enumerate(description.get('sensors', [])):
+            jobs.append((self.make_sensor, {'name': f'sensor_{i}', **spec}))
+
+        self.run_jobs(jobs)
+
+        if unbounded:
+            self.save_bounds(saved_bounds, unbounded)
+
+        for name, dest in self.sensor_dests.items():
+            self.link_sensor(self.sensors[name], self.sensors[dest])
+
+        for spec in description.get('tiled_terrains', []):
+            self.add_tiled_terrain(spec)
+
+    @staticmethod
+    def bounds_key(spec):
+        spec = {key: value for key, value in spec.items() if key != 'comment'}
+        return hashlib.md5(f'{AssembledModel.CACHE_VERSION}:{json.dumps(spec, sort_keys=True)}'.encode()).hexdigest()
+
+    def read_bounds(self):
+        if not os.path.exists(self.BOUNDS_FILE):
+            return {}
+
+        with open(self.BOUNDS_FILE) as f:
+            return json.load(f)
+
+    def save_bounds(self, saved_bounds, specs):
+        for spec in specs:
+            min_pt, max_pt = getattr(self, spec['attr']).get_tight_bounds(self.root)
+            saved_bounds[self.bounds_key(spec)] = [[round(v, 3) for v in min_pt], [round(v, 3) for v in max_pt]]
+
+        os.makedirs(os.path.dirname(self.BOUNDS_FILE), exist_ok=True)
+
+        with open(self.BOUNDS_FILE, 'w') as f:
+            json.dump(saved_bounds, f, indent=2)
+
+    def run_jobs(self, jobs):
+        """Make the objects of the jobs, pairs of a make method and a spec, on the worker threads
+           if any, and add them to the scene and the world on this thread in the order of the jobs.
+        """
+        def make(job):
+            return job[0](job[1])
+
+        if not self.workers:
+            self.add_objects(jobs, map(make, jobs))
+            return
+
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='scene') as executor:
+            self.add_objects(jobs, executor.map(make, jobs))
+
+    def add_objects(self, jobs, objects):
+        for done, ((_, spec), obj) in enumerate(zip(jobs, objects), 1):
+            self.add_object(spec, obj)
+
+            if self.progress is not None:
+                self.progress(done, len(jobs), spec.get('attr', spec.get('name')))
+
+    def make_terrain(self, spec):
+        lod = Lod(**spec['lod']) if 'lod' in spec else None
+        terrain = Terrain(spec['name'], spec['heightmap'], spec['height'], spec['textures'],
+                          block_size=spec.get('block_size', 8), mask=spec.get('mask', 1),
+                          discard=spec.get('discard', True), lod=lod)
+        terrain.set_pos(Point3(*spec.get('pos', (0, 0, 0))))
+
+        if holes := spec.get('holes'):
+            terrain.carve_holes(holes)
+        if spec.get('two_sided'):
+            terrain.root.set_two_sided(True)
+
+        return terrain
+
+    def link_sensor(self, sensor, dest):
+        # a sensor responds with the ray test to its dest from its own zone.
+        sensor.dest_sensor = dest
+        self.layers.attach(dest, self.layers.zones[sensor.node()])
+
+    def add_tiled_terrain(self, spec):
+        """Stream the tiles of a terrain around the walker. The holes and the sensors
+           of the spec are attached with the tiles they are on.
+        """
+        # tiles imports Terrain from this module.
+        from tiles import TiledTerrain, TILE_SOURCES
+
+        source_spec = dict(spec['source'])
+        source = TILE_SOURCES[source_spec.pop('type')](**source_spec)
+        lod = Lod(**spec['lod']) if 'lod' in spec else None
+        tiled = TiledTerrain(self, spec['name'], source, spec['height'], spec['textures'],
+                             origin=Point3(*spec.get('origin', (0, 0, 0))), radius=spec.get('radius', 1),
+                             memory_budget=spec.get('memory_budget', 64 * 2 ** 20),
+                             block_size=spec.get('block_size', 8), mask=spec.get('mask', 1),
+                             discard=spec.get('discard', True), lod=lod, zones=spec.get('zones'))
+
+        for polygon in spec.get('holes', []):
+            tiled.add_hole(polygon)
+
+        for sensor in spec.get('sensors', []):
+            tiled.add_sensor(sensor['name'], Sensors[sensor['type']], sensor['width'], sensor['depth'],
+                             Point3(*sensor['pos']), Vec3(*sensor.get('hpr', (0, 0, 0))), sensor.get('dest'),
+                             sensor.get('zones'))
 
-    def create_terrains(self):
-        tex_files = [
-            ('grass_05.jpg', 20),
-            ('grass_05.jpg', 20),
-        ]
-
-        self.top_ground = Terrain('top_gd', 'top_ground.png', 10, tex_files)
-        # self.top_ground.root.set_two_sided(True)
-        self.attach_nature(self.top_ground)
-        self.top_ground.set_z(-12)
-
-        tex_files = [
-            ('stone_01.jpg', 20),
-            ('grass_04.jpg', 20),
-        ]
-        self.top_mountains = Terrain('top_mt', 'top_terrain.png', 100, tex_files, mask=2)
-        self.top_mountains.root.set_two_sided(True)
-        self.attach_nature(self.top_mountains)
-        self.top_mountains.set_z(0)
-
-        tex_files = [
-            ('stone_01.jpg', 20),
-            ('stones_01.jpg', 20),
-        ]
+        setattr(self, spec['attr'], tiled)
+        self.add_stream(tiled)
+
+    def make_model(self, spec):
+        model_cls = MODEL_TYPES[spec['type']]
+        if model_cls is WaterSurface and self.gpu_water:
+            model_cls = GpuWaterSurface
+
+        model = model_cls(**spec.get('params', {}))
+        model.set_pos_hpr(Point3(*spec.get('pos', (0, 0, 0))), Vec3(*spec.get('hpr', (0, 0, 0))))
+        return model
 
-        self.mid_ground = Terrain('mid_gd', 'mid_ground.png', 20, tex_files, block_size=4, discard=False)
-        self.mid_ground.make_hole(6, 10)
-        # block_np = self.terrain.getBlockNodePath(2, 5)  # blocksize=8
-        self.attach_nature(self.mid_ground)
-        self.mid_ground.set_z(-56)   # -58
+    def make_sensor(self, spec):
+        sensor = Sensor(spec['name'], Sensors[spec['type']], spec['width'], spec['depth'])
+        sensor.set_pos_hpr(Point3(*spec['pos']), Vec3(*spec.get('hpr', (0, 0, 0))))
+        return sensor
 
-        tex_files = [
-            ('rock_02.jpg', 20),
-            ('stone_01.jpg', 10),
-        ]
-        self.mid_mountains = Terrain('mid_mt', 'mid_terrain.png', 100, tex_files, mask=2)
-        self.mid_mountains.root.setTwoSided(True)
-        self.attach_nature(self.mid_mountains)
-        self.mid_mountains.set_z(-48)
+    def add_object(self, spec, obj):
+        self.attach_nature(obj, zones=spec.get('zones'))
 
-    def setup_environments(self):
-        self.sky = Sky()
-        self.sky.reparent_to(self.root)
+        if isinstance(obj, Sensor):
+            self.sensors[spec['name']] = obj
+            if dest := spec.get('dest'):
+                self.sensor_dests[spec['name']] = dest
+        else:
+            setattr(self, spec['attr'], obj)
 
-        # tunnel on the top ground
-        self.tunnel = SquareTunnel()
-        self.attach_nature(self.tunnel)
-        self.tunnel.set_pos(Point3(-7.8244, -7.0682, -10.6803))
-
-        # big cave on the top ground
-        self.cave = Cave(width=8, depth=15, wall_height=10, thickness=1.5)
-        self.attach_nature(self.cave)
-        self.cave.set_pos_hpr(Point3(32.8145, 3.5, -13.7908), Vec3(-11, 0, 0))
-
-        # small cave on the top ground
-        self.small_cave = Cave(width=6, depth=3, wall_height=4, thickness=1.5)
-        self.attach_nature(self.small_cave)
-        self.small_cave.set_pos_hpr(Point3(-18.9, 18.2, -10.3), Vec3(-7, 0, 0))
-
-        # tunnel from top ground to mig ground
-        self.passage = RoundTunnel()
-        self.attach_nature(self.passage)
-        self.passage.set_pos(Point3(-19.05, 17.7, -12))
-
-        # water surface on the mid ground
-        self.mid_water = WaterSurface(w=64.5, d=129)
-        self.attach_nature(self.mid_water)
-        self.mid_water.set_pos(Point3(32.25, 0, -60))
-
-        # room under the mid ground
-        self.basement = Basement()
-        self.attach_nature(self.basement)
-        self.basement.set_pos(-38.1466, -21.9663, -54.3114)
-
-    def create_sensor(self):
-        self.sensors = {}
+    def build_model(self, spec):
+        self.add_object(spec, model := self.make_model(spec))
+        return model
 
-        sensors = [
-            [None, 4, 6, Sensors.TUNNEL, Point3(32.179, -3.35926, -15.7665), Vec3(-11, 0, 0)],    # big cave
-            [None, 3, 4, Sensors.TUNNEL, Point3(-18.8616, 17.5443, -11.5), Vec3(-8, 0, 0)],       # small cave
-            [None, 2, 6, Sensors.TUNNEL, Point3(5.4917, -17.8313, -14.3056), Vec3(64, 0, 0)],     # tunnel in the side of the bit cave
-            [None, 2, 4, Sensors.TUNNEL, Point3(-19.2, 3.09684, -11.728), Vec3(31, 0, 0)],        # tunnel in the side of the small cave
-            ['passage', 1.5, 1.5, Sensors.HOLE, Point3(-19.05, 17.6, -12), Vec3(-1.0, 0, 0)],     # hole to enter passage
-            ['basement', 3, 3, Sensors.HOLE, Point3(-38.1466, -21.9663, -53.4), Vec3(0, 0, 0)],   # hole to enter basement
-        ]
+    def load_near(self, pos):
+        """Build the pending models whose bounds are within load_radius from pos."""
+        for spec in [spec for spec in self.pending if self.distance_to(spec['bounds'], pos) <= self.load_radius]:
+            self.pending.remove(spec)
+            self.index_nature(self.build_model(spec))
 
-        for i, (name, width, depth, sensor, pos, hpr) in enumerate(sensors):
-            nm = f'sensor_{i}' if not name else name
-            underground_sensor = Sensor(nm, sensor, width, depth)
-            underground_sensor.set_pos_hpr(pos, hpr)
-            self.attach_nature(underground_sensor)
-            self.sensors[nm] = underground_sensor
+    def load_all(self):
+        for spec in self.pending:
+            self.index_nature(self.build_model(spec))
 
-        sensors = [
-            ['basement_', 3.5, 12, Sensors.STEPS, Point3(-38.1466, -23.5, -58.26), Vec3(0, 55.5, 0)],  # steps in the basement
-            ['passage_', 1.5, 1.5, Sensors.MID_GROUND, Point3(-19.05, 17.6, -59.7), Vec3(0, 0, 0)],    # landing place of passage
-        ]
+        self.pending.clear()
 
-        for i, (name, width, depth, sensor, pos, hpr) in enumerate(sensors):
-            underground_sensor = Sensor(name, sensor, width, depth)
-            underground_sensor.set_pos_hpr(pos, hpr)
-            self.attach_nature(underground_sensor)
-            parent_sensor = self.sensors[name[:-1]]
-            parent_sensor.dest_sensor = underground_sensor
+    @staticmethod
+    def distance_to(bounds, pos):
+        (min_x, min_y, min_z), (max_x, max_y, max_z) = bounds
+        dx = max(min_x - pos.x, 0, pos.x - max_x)
+        dy = max(min_y - pos.y, 0, pos.y - max_y)
+        dz = max(min_z - pos.z, 0, pos.z - max_z)
+        return (dx ** 2 + dy ** 2 + dz ** 2) ** 0.5
 
+    @timed('scene:check_sensors')
     def check_sensors(self, from_pos, mask, distance=-5):
         to_pos = from_pos + Vec3(0, 0, distance)
+        candidates = self.sensor_index.query(from_pos.x, from_pos.y, to_pos.z, from_pos.z)
+
+        # Ray test is needed only if the point is over one of the sensors.
+        if not any(sensor.sensor.mask == mask for sensor in candidates):
+            return None
 
-        if (hit := base.world.ray_test_closest(
-                from_pos, to_pos, BitMask32.bit(mask))).has_hit():
+        if (hit := self.queries.ray_test(
+                'sensors', from_pos, to_pos, BitMask32.bit(mask))).has_hit():
             key = hit.get_node().get_name()
             sensor = self.sensors[key]
             return sensor
\ No newline at end of file
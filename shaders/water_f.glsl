@@ -0,0 +1,11 @@
+#version 300 es
+precision highp float;
+
+uniform sampler2D p3d_Texture0;
+
+in vec2 texcoord0;
+out vec4 fragColor;
+
+void main() {
+    fragColor = texture(p3d_Texture0, texcoord0.st).rgba;
+}
@@ -0,0 +1,29 @@
+#version 300 es
+precision highp float;
+uniform mat4 p3d_ModelViewProjectionMatrix;
+
+// each wave component is a pair of (wave height, speed).
+const int MAX_WAVES = 8;
+uniform vec2 waves[MAX_WAVES];
+uniform int wave_count;
+uniform float time;
+
+in vec4 p3d_Vertex;
+in vec2 p3d_MultiTexCoord0;
+
+out vec2 texcoord0;
+
+void main() {
+    vec4 vertex = p3d_Vertex;
+    float z = 0.0;
+
+    for (int i = 0; i < wave_count; i++) {
+        float wave_h = waves[i].x;
+        float t = time * waves[i].y;
+        z += (sin(t + vertex.x / wave_h) + sin(t + vertex.y / wave_h)) * wave_h / 2.0;
+    }
+
+    vertex.z = z;
+    gl_Position = p3d_ModelViewProjectionMatrix * vertex;
+    texcoord0 = p3d_MultiTexCoord0;
+}
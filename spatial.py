@@ -0,0 +1,70 @@
+import math
+import numpy as np
+from collections import defaultdict
+
+
+class GridIndex:
+    """Uniform grid on the xy plane that maps each cell to the items
+       whose axis-aligned bounding boxes overlap it.
+    """
+
+    def __init__(self, cell_size=8):
+        self.cell_size = cell_size
+        self.cells = defaultdict(list)
+
+    def get_cell(self, x, y):
+        return math.floor(x / self.cell_size), math.floor(y / self.cell_size)
+
+    def insert(self, item, min_pt, max_pt):
+        entry = (item, min_pt, max_pt)
+        min_x, min_y = self.get_cell(min_pt.x, min_pt.y)
+        max_x, max_y = self.get_cell(max_pt.x, max_pt.y)
+
+        for cx in range(min_x, max_x + 1):
+            for cy in range(min_y, max_y + 1):
+                self.cells[(cx, cy)].append(entry)
+
+    def remove(self, item):
+        for key in list(self.cells):
+            if not (entries := [e for e in self.cells[key] if e[0] is not item]):
+                del self.cells[key]
+            else:
+                self.cells[key] = entries
+
+    def entries(self):
+        """Return the (item, min_pt, max_pt) of each item once."""
+        entries = {}
+        for cell in self.cells.values():
+            for entry in cell:
+                entries.setdefault(id(entry[0]), entry)
+
+        return list(entries.values())
+
+    def query(self, x, y, bottom=-math.inf, top=math.inf):
+        """Return the items whose bounding boxes contain the point (x, y)
+           and overlap the z range from bottom to top.
+        """
+        if (entries := self.cells.get(self.get_cell(x, y))) is None:
+            return []
+
+        return [item for item, min_pt, max_pt in entries
+                if min_pt.x <= x <= max_pt.x and min_pt.y <= y <= max_pt.y
+                and bottom <= max_pt.z and top >= min_pt.z]
+
+
+def points_in_polygon(px, py, polygon):
+    """Return a boolean array telling which of the points (px, py) are
+       inside the polygon, which is a sequence of (x, y) vertices.
+    """
+    px = np.asarray(px)
+    py = np.asarray(py)
+    inside = np.zeros(np.broadcast(px, py).shape, dtype=bool)
+    x0, y0 = polygon[-1]
+
+    for x1, y1 in polygon:
+        if y0 != y1:
+            crosses = ((y1 > py) != (y0 > py)) & (px < (x0 - x1) * (py - y1) / (y0 - y1) + x1)
+            inside ^= crosses
+        x0, y0 = x1, y1
+
+    return inside
@@ -4,11 +4,17 @@ from panda3d.bullet import BulletWorld, BulletDebugNode
 from direct.showbase.ShowBase import ShowBase
 from direct.showbase.ShowBaseGlobal import globalClock
 from direct.showbase.InputStateGlobal import inputState
+from direct.gui.OnscreenText import OnscreenText
 from panda3d.core import load_prc_file_data
-from panda3d.core import NodePath, Point3, Vec3, BitMask32, Quat
+from panda3d.core import NodePath, Point3, Vec3, BitMask32
+from panda3d.core import PerspectiveLens, TextNode
 
 from walker import Walker, Motions, Status
 from scene import Scene
+from camera import CameraSolver
+from timestep import FixedStep
+from instrumentation import instruments, timed, Overlay
+from crowd import Crowd
 
 
 load_prc_file_data("", """
@@ -22,26 +28,43 @@ load_prc_file_data("", """
 
 class TerrainWithHole(ShowBase):
 
-    def __init__(self):
+    CAMERA_MASK = BitMask32.bit(2) | BitMask32.bit(3) | BitMask32.bit(7)
+
+    def __init__(self, fixed_step=True, logic_rate=60, physics_rate=60, max_substeps=5, crowd=0, lazy=True,
+                 workers=0, scene='scenes/default.json'):
         super().__init__()
         self.disable_mouse()
 
+        if self.win is None:
+            # No window is opened with "window-type none", for example in benchmark.
+            self.camera = self.render.attach_new_node('camera')
+            self.camLens = PerspectiveLens()
+
         self.world = BulletWorld()
         self.world.set_gravity(Vec3(0, 0, -9.81))
 
         self.debug = self.render.attach_new_node(BulletDebugNode('debug'))
         self.world.set_debug_node(self.debug.node())
 
-        self.scene = Scene()
+        self.loading_text = None
+        self.scene = Scene(scene, lazy=lazy, workers=workers, progress=self.show_progress)
         self.scene.root.reparent_to(self.render)
 
+        if self.loading_text is not None:
+            self.loading_text.destroy()
+
         self.walker = Walker()
         self.walker.reparent_to(self.render)
         self.walker.set_pos(Point3(-18.0243, 14.9644, -9.21977))
+        self.scene.load_streams(self.walker.get_pos())
+        self.walker.zone = self.scene.zone_below(self.walker.get_pos())
         self.floater = NodePath('floater')
         self.floater.set_z(3.0)
         self.floater.reparent_to(self.walker)
 
+        # NPC walkers sharing the state machine of the walker.
+        self.crowd = Crowd(self.scene, crowd) if crowd else None
+
         self.camera.reparent_to(self.render)
         self.cam_distance = Vec3(0, -5, 1)
         self.camera.set_pos(self.walker.get_pos() + self.cam_distance)
@@ -49,8 +72,21 @@ class TerrainWithHole(ShowBase):
         self.camLens.set_near_far(0.1, 10000)
         self.camLens.set_fov(90)
 
+        # mountains can block the camera's view.
+        mountains = [terrain for terrain in self.scene.terrains
+                     if not (terrain.get_collide_mask() & BitMask32.bit(2)).is_zero()]
+        self.camera_solver = CameraSolver(self.scene.queries, self.CAMERA_MASK, mountains)
+
+        # With fixed_step, the walker and the camera are moved by the logic clock and the physics
+        # is stepped by the physics clock; the rendered transforms are interpolated between steps.
+        self.fixed_step = fixed_step
+        self.logic_clock = FixedStep(logic_rate, max_substeps)
+        self.physics_clock = FixedStep(physics_rate, max_substeps)
+        self.reset_interpolation()
+
         self.state = False
         self.is_falling = False
+        self.overlay = None
 
         inputState.watch_with_modifiers('forward', 'arrow_up')
         inputState.watch_with_modifiers('backward', 'arrow_down')
@@ -62,14 +98,28 @@ class TerrainWithHole(ShowBase):
         self.accept('i', self.print_info)
         self.accept('escape', sys.exit)
         self.accept('d', self.toggle_debug)
+        self.accept('f', self.toggle_instruments)
         self.taskMgr.add(self.update, 'update')
 
+    def show_progress(self, done, total, name):
+        """Show the progress of the scene construction on the loading screen."""
+        if self.win is None:
+            return
+
+        if self.loading_text is None:
+            self.loading_text = OnscreenText(
+                pos=(0, 0), scale=0.06, fg=(1, 1, 1, 1), align=TextNode.A_center, mayChange=True)
+
+        self.loading_text.setText(f'Loading {name} ({done}/{total})')
+        self.graphicsEngine.render_frame()
+
     def go_down(self, is_down):
         direction = 1
         if is_down:
             direction *= -1
         z = self.walker.get_z() + direction
         self.walker.set_z(z)
+        self.reset_interpolation()
 
     def print_info(self):
         print(self.walker.get_pos())
@@ -81,27 +131,24 @@ class TerrainWithHole(ShowBase):
         else:
             self.debug.hide()
 
-    def ray_cast(self, from_pos, to_pos):
-        mask = BitMask32.bit(2) | BitMask32.bit(3) | BitMask32.bit(7)
+    def toggle_instruments(self):
+        if self.win is None:
+            return
 
-        if (result := self.world.ray_test_closest(from_pos, to_pos, mask)).has_hit():
+        if self.overlay is None:
+            self.overlay = Overlay()
+        self.overlay.toggle()
+
+    def ray_cast(self, from_pos, to_pos):
+        if (result := self.scene.queries.ray_test(
+                'camera', from_pos, to_pos, self.CAMERA_MASK)).has_hit():
             return result.get_node()
 
         return None
 
     def rotate_camera(self, walker_pos, camera_pos):
-        q = Quat()
-        next_pos = walker_pos + self.walker.direction_relative_pos(Vec3(0, 5, 1))
-
-        for i in range(36):
-            if node := self.ray_cast(next_pos, walker_pos):
-                if node == self.walker.node():
-                    return next_pos
-
-            n = i // 2 + 1
-            angle = 10 * n if i % 2 == 0 else -10 * n
-            q.set_from_axis_angle(angle, Vec3.up())
-            next_pos = q.xform(camera_pos - walker_pos) + walker_pos
+        default_pos = walker_pos + self.walker.direction_relative_pos(Vec3(0, 5, 1))
+        return self.camera_solver.solve(self.walker.node(), walker_pos, camera_pos, default_pos)
 
     def watch_falling(self, walker_pos, camera_pos, dt):
         next_pos = Point3()
@@ -111,17 +158,26 @@ class TerrainWithHole(ShowBase):
         self.camera.set_pos(next_pos)
         self.camera.look_at(self.floater)
 
+    def is_view_blocked(self, walker_pos, camera_pos):
+        # The ray test is not needed if the occlusion maps show the view is buried in a terrain.
+        if self.camera_solver.is_buried(walker_pos, camera_pos):
+            return True
+
+        return (node := self.ray_cast(camera_pos, walker_pos)) is not None \
+            and node != self.walker.node()
+
     def camera_outside(self, walker_pos, camera_pos):
         """Reposition the camera if the camera's view is blocked
            by other objects like terrain.
         """
-        if (node := self.ray_cast(camera_pos, walker_pos)) is not None \
-                and node != self.walker.node():
+        if self.is_view_blocked(walker_pos, camera_pos):
             if next_pos := self.rotate_camera(walker_pos, camera_pos):
                 self.camera.set_pos(next_pos)
                 self.camera.look_at(self.floater)
                 self.cam_distance = next_pos - walker_pos
                 return
+        else:
+            self.camera_solver.reset()
 
         self.camera.set_pos(walker_pos + self.cam_distance)
         self.camera.look_at(self.floater)
@@ -133,10 +189,13 @@ class TerrainWithHole(ShowBase):
         if (node := self.ray_cast(camera_pos, walker_pos)) is not None \
                 and node != self.walker.node():
             self.camera.set_pos(self.scene.basement.room_camera.get_pos(self.render))
+            # jump to the roof instead of sliding there through the walls by the interpolation.
+            self.camera_from = self.camera.get_pos()
             self.change_camera = True
 
         self.camera.look_at(self.floater)
 
+    @timed('camera:control')
     def control_camera(self, dt):
         walker_pos = self.walker.get_pos()
         camera_pos = self.camera.get_pos()
@@ -152,7 +211,7 @@ class TerrainWithHole(ShowBase):
             case _:
                 self.camera_outside(walker_pos, camera_pos)
 
-    def control_walker(self, dt):
+    def get_key_inputs(self):
         motions = []
 
         if inputState.is_set('forward'):
@@ -164,19 +223,92 @@ class TerrainWithHole(ShowBase):
         if inputState.is_set('right'):
             motions.append(Motions.RIGHT)
 
-        self.walker.update(dt, motions)
+        return motions
 
-    def update(self, task):
-        dt = globalClock.get_dt()
+    def control_walker(self, dt):
+        motions = self.get_key_inputs()
+
+        # the probes of the walker only traverse the objects in its zone.
+        with self.scene.queries.route(self.walker.zone):
+            self.walker.update(dt, motions)
 
+    def reset_interpolation(self):
+        """Call after the walker or the camera is moved directly."""
+        self.walker.store_transform()
+        self.camera_from = self.camera_to = self.camera.get_pos()
+
+    def interpolate(self, alpha):
+        offset = self.walker.interpolate(alpha)
+        self.camera.set_pos(self.camera_from + (self.camera_to - self.camera_from) * alpha)
+        self.camera.look_at(self.floater.get_pos(self.render) + offset)
+
+    def tick(self, dt):
+        self.scene.queries.begin_frame()
         self.control_walker(dt)
         self.control_camera(dt)
-        self.scene.mid_water.wave(task.time)
 
-        self.world.do_physics(dt)
+        if self.crowd is not None:
+            self.crowd.update(dt)
+
+    @timed('physics:do_physics')
+    def do_physics(self, dt, max_substeps=1, stepsize=1 / 60):
+        self.world.do_physics(dt, max_substeps, stepsize)
+
+    def end_frame(self, time):
+        # the water is built when the walker comes near it.
+        if self.scene.mid_water is not None:
+            self.scene.mid_water.wave(time)
+        instruments.end_frame()
+
+        if self.overlay is not None:
+            self.overlay.update()
+
+    def update(self, task):
+        dt = globalClock.get_dt()
+        self.scene.update(self.walker.get_pos())
+
+        if not self.fixed_step:
+            self.tick(dt)
+            self.do_physics(dt)
+            self.end_frame(task.time)
+            return task.cont
+
+        if steps := self.logic_clock.advance(dt):
+            # The logic has to start from the camera position it left, not the interpolated one.
+            self.camera.set_pos(self.camera_to)
+
+            for _ in range(steps):
+                self.walker.store_transform()
+                self.camera_from = self.camera.get_pos()
+                self.tick(self.logic_clock.step)
+
+            self.camera_to = self.camera.get_pos()
+
+        step = self.physics_clock.step
+        for _ in range(self.physics_clock.advance(dt)):
+            self.do_physics(step, 1, step)
+
+        self.interpolate(self.logic_clock.alpha)
+        self.end_frame(task.time)
         return task.cont
 
 
 if __name__ == '__main__':
-    app = TerrainWithHole()
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Walk through the terrain with holes.')
+    parser.add_argument('crowd', nargs='?', type=int, default=0, help='number of NPC walkers.')
+    parser.add_argument('scene', nargs='?', default='scenes/default.json', help='scene description file.')
+    parser.add_argument('--instruments', help='file to dump the per-frame counters and timers, .csv or .json.')
+    parser.add_argument('--dump-interval', type=int, default=300, help='frames between the dumps.')
+    parser.add_argument('--pstats', action='store_true', help='send the counters and timers to PStats.')
+    parser.add_argument('--workers', type=int, default=0, help='number of threads to build the scene on.')
+    args = parser.parse_args()
+
+    if args.pstats:
+        instruments.connect_pstats()
+    if args.instruments or args.pstats:
+        instruments.enable(args.instruments, args.dump_interval)
+
+    app = TerrainWithHole(crowd=args.crowd, workers=args.workers, scene=args.scene)
     app.run()
\ No newline at end of file
@@ -0,0 +1,265 @@
+import math
+import os
+import re
+from collections import OrderedDict, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+from panda3d.core import NodePath, PNMImage, PNMImageHeader, Filename, Point3
+
+from assets import Heightfield
+from rawheightfield import RawHeightfield
+from scene import Terrain, Sensor
+
+
+class ImageTiles:
+    """Split a large heightmap into square tiles of cells x cells.
+       Adjacent tiles share the points on their borders, so the size
+       of the heightmap must be a multiple of cells plus 1.
+    """
+
+    def __init__(self, path, cells=128):
+        self.img = PNMImage(Filename(path))
+        self.cells = cells
+        size_x, size_y = self.img.get_size()
+        self.keys = {(tx, ty) for tx in range((size_x - 1) // cells) for ty in range((size_y - 1) // cells)}
+
+    def load(self, tx, ty):
+        # the image rows are upside down against the grid.
+        n = self.cells + 1
+        rows = self.img.get_y_size()
+        img = PNMImage(n, n, self.img.get_num_channels(), self.img.get_maxval())
+        img.copy_sub_image(self.img, 0, 0, tx * self.cells, rows - 1 - (ty + 1) * self.cells, n, n)
+        return img
+
+
+class DirectoryTiles:
+    """Tiles stored as separate heightmaps named <prefix>_<tx>_<ty>.png in a directory.
+       All the tiles must have the same size, cells + 1, and share their borders.
+    """
+
+    def __init__(self, directory, prefix='tile'):
+        pattern = re.compile(rf'{re.escape(prefix)}_(-?\d+)_(-?\d+)\.png$')
+        self.files = {}
+
+        for file_name in os.listdir(directory):
+            if m := pattern.match(file_name):
+                self.files[(int(m.group(1)), int(m.group(2)))] = os.path.join(directory, file_name)
+
+        if not self.files:
+            raise FileNotFoundError(f'no tiles named {prefix}_<tx>_<ty>.png in {directory}')
+
+        header = PNMImageHeader()
+        header.read_header(Filename(next(iter(self.files.values()))))
+        self.cells = header.get_x_size() - 1
+        self.keys = set(self.files)
+
+    def load(self, tx, ty):
+        return PNMImage(Filename(self.files[(tx, ty)]))
+
+
+class RawTiles:
+    """Split a heightfield file of the raw format into tiles like ImageTiles.
+       Only the pages of the rows of a tile are read when the tile is loaded.
+    """
+
+    def __init__(self, path, cells=128):
+        self.raw = RawHeightfield(path)
+        self.cells = cells
+        rows, cols = self.raw.shape
+        self.keys = {(tx, ty) for tx in range((cols - 1) // cells) for ty in range((rows - 1) // cells)}
+
+    def load(self, tx, ty):
+        i0, j0 = tx * self.cells, ty * self.cells
+        return self.raw.image(i0, j0, i0 + self.cells, j0 + self.cells)
+
+
+# the sources of tiles by the type in the scene description.
+TILE_SOURCES = {
+    'image': ImageTiles,
+    'directory': DirectoryTiles,
+    'raw': RawTiles,
+}
+
+
+def tile_bytes(terrain):
+    """Estimate the memory used by a loaded tile: the image, the texture, the arrays,
+       the heights copied by Bullet and the vertices and indices of the blocks.
+    """
+    size_x, size_y = terrain.img.get_size()
+    size = size_x * size_y * ((3 + terrain.img.has_alpha()) * 2 + 4)
+    size += terrain.heightfield.texture.get_ram_image_size()
+    size += terrain.heights.nbytes + terrain.removed.nbytes + terrain.hole_mask.nbytes
+
+    if terrain.heightfield.alpha is not None:
+        size += terrain.heightfield.alpha.nbytes
+
+    for block_np in terrain.root.find_all_matches('**/+GeomNode'):
+        for geom in block_np.node().get_geoms():
+            vdata = geom.get_vertex_data()
+            size += sum(vdata.get_array(i).get_data_size_bytes() for i in range(vdata.get_num_arrays()))
+            size += sum(geom.get_primitive(i).get_vertices().get_data_size_bytes()
+                        for i in range(geom.get_num_primitives()))
+
+    return size
+
+
+class TiledTerrain:
+    """Keep the terrain tiles around the walker loaded, for a world larger than one heightmap.
+       Tiles are built on a background thread and attached to the scene on the main thread.
+       Loaded tiles are kept in least recently used order, and the oldest ones out of
+       the radius are unloaded when they use more memory than memory_budget bytes.
+       Holes and sensors are registered in world coordinates and attached with their tiles.
+    """
+
+    def __init__(self, scene, name, source, height, tex_files, origin=Point3(0, 0, 0),
+                 radius=1, memory_budget=64 * 2 ** 20, block_size=8, mask=1, discard=True, lod=None, zones=None):
+        self.scene = scene
+        self.name = name
+        self.source = source
+        self.height = height
+        self.tex_files = tex_files
+        self.origin = origin
+        self.radius = radius
+        self.memory_budget = memory_budget
+        self.block_size = block_size
+        self.mask = mask
+        self.discard = discard
+        self.lod = lod
+        self.zones = zones
+
+        self.root = NodePath(f'tiled_{name}')
+        self.root.reparent_to(scene.root)
+        self.loaded = OrderedDict()
+        self.pending = {}
+        self.sizes = {}
+        self.used_bytes = 0
+        self.holes = defaultdict(list)
+        self.sensors = defaultdict(list)
+        self.attached_sensors = defaultdict(list)
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix=f'tiles_{name}')
+
+    def tile_of(self, x, y):
+        cells = self.source.cells
+        return math.floor((x - self.origin.x) / cells), math.floor((y - self.origin.y) / cells)
+
+    def tile_center(self, tx, ty):
+        cells = self.source.cells
+        return self.origin + Point3((tx + 0.5) * cells, (ty + 0.5) * cells, 0)
+
+    def add_hole(self, polygon):
+        """Register a hole, a sequence of (x, y) in world coordinates, on the tiles it overlaps."""
+        xs = [x for x, _ in polygon]
+        ys = [y for _, y in polygon]
+        min_tx, min_ty = self.tile_of(min(xs), min(ys))
+        max_tx, max_ty = self.tile_of(max(xs), max(ys))
+
+        for tx in range(min_tx, max_tx + 1):
+            for ty in range(min_ty, max_ty + 1):
+                self.holes[(tx, ty)].append(polygon)
+
+                if (terrain := self.loaded.get((tx, ty))) is not None:
+                    terrain.carve_holes([polygon])
+
+    def add_sensor(self, name, sensor, width, depth, pos, hpr, dest=None, zones=None):
+        """Register a sensor on the tile including pos. dest is the name of the sensor
+           to be set to dest_sensor, which is linked when both of them are attached.
+           The sensor is put in the zones, or in the zones of the terrain if None.
+        """
+        key = self.tile_of(pos.x, pos.y)
+        spec = (name, sensor, width, depth, pos, hpr, dest, self.zones if zones is None else zones)
+        self.sensors[key].append(spec)
+
+        if key in self.loaded:
+            self.attach_sensor(key, spec)
+
+    def attach_sensor(self, key, spec):
+        name, sensor, width, depth, pos, hpr, dest, zones = spec
+        nd = Sensor(name, sensor, width, depth)
+        nd.set_pos_hpr(pos, hpr)
+        self.scene.attach_nature(nd, zones=zones)
+        self.scene.index_nature(nd)
+        self.scene.sensors[name] = nd
+        self.attached_sensors[key].append(nd)
+
+        if dest and (dest_nd := self.scene.sensors.get(dest)) is not None:
+            self.scene.link_sensor(nd, dest_nd)
+
+        for specs in self.sensors.values():
+            for other_name, *_, other_dest, _ in specs:
+                if other_dest == name and (other := self.scene.sensors.get(other_name)) is not None:
+                    self.scene.link_sensor(other, nd)
+
+    def build_tile(self, tx, ty):
+        """Create the terrain of a tile. Called on the background thread."""
+        img = self.source.load(tx, ty)
+        terrain = Terrain(f'{self.name}_{tx}_{ty}', Heightfield(img), self.height, self.tex_files,
+                          block_size=self.block_size, mask=self.mask, discard=self.discard, lod=self.lod)
+        terrain.set_pos(self.tile_center(tx, ty))
+        return terrain
+
+    def attach_tile(self, key, terrain):
+        # holes must be carved after the terrain is positioned, because they are in world coordinates.
+        terrain.reparent_to(self.root)
+        if polygons := self.holes.get(key):
+            terrain.carve_holes(polygons)
+
+        self.scene.attach_nature(terrain, self.root, self.zones)
+        self.scene.index_nature(terrain)
+        self.loaded[key] = terrain
+
+        for spec in self.sensors.get(key, []):
+            self.attach_sensor(key, spec)
+
+        self.sizes[key] = tile_bytes(terrain)
+        self.used_bytes += self.sizes[key]
+
+    def detach_tile(self, key):
+        for sensor in self.attached_sensors.pop(key, []):
+            self.scene.sensors.pop(sensor.get_name(), None)
+            self.scene.detach_nature(sensor)
+            sensor.remove_node()
+
+        terrain = self.loaded.pop(key)
+        self.scene.detach_nature(terrain)
+        terrain.remove_node()
+        self.used_bytes -= self.sizes.pop(key)
+
+    def update(self, pos, wait=False):
+        """Request the tiles within the radius around pos, attach the tiles built since
+           the last call and unload old tiles. If wait is True, block until all the
+           requested tiles are attached, for example before the walker is placed.
+        """
+        cx, cy = self.tile_of(pos.x, pos.y)
+        wanted = sorted(
+            ((tx, ty) for tx in range(cx - self.radius, cx + self.radius + 1)
+             for ty in range(cy - self.radius, cy + self.radius + 1) if (tx, ty) in self.source.keys),
+            key=lambda k: (k[0] - cx) ** 2 + (k[1] - cy) ** 2
+        )
+
+        for key in wanted:
+            if key in self.loaded:
+                self.loaded.move_to_end(key)
+            elif key not in self.pending:
+                self.pending[key] = self.executor.submit(self.build_tile, *key)
+
+        for key, future in list(self.pending.items()):
+            if wait or future.done():
+                del self.pending[key]
+                self.attach_tile(key, future.result())
+
+        self.evict(set(wanted))
+
+    def evict(self, wanted):
+        for key in list(self.loaded):
+            if self.used_bytes <= self.memory_budget:
+                break
+            if key not in wanted:
+                self.detach_tile(key)
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True, cancel_futures=True)
+
+        for key in list(self.loaded):
+            self.detach_tile(key)
+
+        self.root.remove_node()
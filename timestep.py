@@ -0,0 +1,26 @@
+class FixedStep:
+    """Accumulate the frame time and split it into steps of a fixed length.
+       If frames are too long, at most max_steps steps are run in a frame and
+       the rest of the time is dropped, so that the cost per frame is bounded.
+    """
+
+    def __init__(self, rate, max_steps=5):
+        self.step = 1 / rate
+        self.max_steps = max_steps
+        self.accumulator = 0
+
+    def advance(self, dt):
+        """Return the number of steps to run for the frame time dt."""
+        self.accumulator += dt
+        steps = min(int(self.accumulator / self.step), self.max_steps)
+        self.accumulator -= steps * self.step
+
+        if steps == self.max_steps:
+            self.accumulator = min(self.accumulator, self.step)
+
+        return steps
+
+    @property
+    def alpha(self):
+        """Fraction of a step left over, used to interpolate between the last two steps."""
+        return min(self.accumulator / self.step, 1.0)
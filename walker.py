@@ -7,6 +7,7 @@ from panda3d.bullet import BulletRigidBodyNode
 from panda3d.core import PandaNode, NodePath, TransformState
 from panda3d.core import Vec2, Vec3, BitMask32
 
+from instrumentation import timed
 from scene import Sensors
 
 
@@ -32,6 +33,7 @@ class Walker(NodePath):
 
     RUN = 'run'
     WALK = 'walk'
+    ACTOR_POS = Vec3(0, 0, -2.5)
 
     def __init__(self):
         super().__init__(BulletRigidBodyNode('wolker'))
@@ -39,6 +41,8 @@ class Walker(NodePath):
 
         self.responded_sensor = None
         self.status = Status.MOVE
+        # the zone of the layers where the queries of the walker go; it changes at the hole sensors.
+        self.zone = None
 
         h, w = 6, 1.2
         shape = BulletCapsuleShape(w, h - 2 * w, ZUp)
@@ -60,28 +64,39 @@ class Walker(NodePath):
             {self.RUN: 'models/ralph/ralph-run.egg',
              self.WALK: 'models/ralph/ralph-walk.egg'}
         )
-        self.actor.set_transform(TransformState.make_pos(Vec3(0, 0, -2.5)))
+        self.actor.set_transform(TransformState.make_pos(self.ACTOR_POS))
         self.actor.set_name('ralph')
         self.actor.reparent_to(self.direction_nd)
 
+    def store_transform(self):
+        self.prev_pos = self.get_pos()
+        self.prev_h = self.direction_nd.get_h()
+
+    def interpolate(self, alpha):
+        """Place the actor between the positions and the headings before and after
+           the last update. Returns the offset of the actor from the walker in world space.
+        """
+        offset = (self.prev_pos - self.get_pos()) * (1 - alpha)
+        self.actor.set_pos(self, self.get_relative_vector(base.render, offset) + self.ACTOR_POS)
+
+        diff_h = (self.prev_h - self.direction_nd.get_h() + 180) % 360 - 180
+        self.actor.set_h(diff_h * (1 - alpha))
+        return offset
+
     def direction_relative_pos(self, pt):
         return self.get_relative_point(self.direction_nd, pt)
 
     def check_downward(self, from_pos, distance=-2.5):
-        to_pos = from_pos + Vec3(0, 0, distance)
         mask = BitMask32.bit(1) | BitMask32.bit(3) | BitMask32.bit(6)
-
-        if (hit := base.world.ray_test_closest(from_pos, to_pos, mask)).has_hit():
-            return hit
-        return None
+        return base.scene.cast_down(from_pos, mask, distance, 'downward')
 
     def predict_collision(self, current_pos, next_pos):
         ts_from = TransformState.make_pos(current_pos)
         ts_to = TransformState.make_pos(next_pos)
         mask = BitMask32.bit(2) | BitMask32.bit(3)
 
-        if (result := base.world.sweep_test_closest(
-                self.test_shape, ts_from, ts_to, mask, 0.0)).has_hit():
+        if (result := base.scene.queries.sweep_test(
+                'collision', self.test_shape, ts_from, ts_to, mask, 0.0)).has_hit():
             return result
 
     def parse_args(self, key_inputs):
@@ -118,6 +133,7 @@ class Walker(NodePath):
             angle = 100 * direction.x * dt
             self.direction_nd.set_h(self.direction_nd.get_h() + angle)
 
+    @timed('walker:move')
     def move(self, direction, dt):
         if not direction.y:
             return
@@ -128,12 +144,16 @@ class Walker(NodePath):
         next_pos = current_pos + orientation * direction.y * speed * dt
         hit_z = None
 
-        # Check a hole in the ground.
-        if sensor := base.scene.check_sensors(current_pos, Sensors.HOLE.mask):
+        # Check a hole in the ground; sensors are looked for only near holes in the terrains.
+        # Holes in the collision shapes can be a little larger than the sensors.
+        if base.scene.over_hole(current_pos) and \
+                (sensor := base.scene.check_sensors(current_pos, Sensors.HOLE.mask)
+                 or base.scene.check_sensors(next_pos, Sensors.HOLE.mask)):
             # If a landing point is far, the character will fall into the hole.
             if not (sensor_hit := sensor.dest_sensor.respond(next_pos)):
                 self.set_pos(next_pos)
                 self.responded_sensor = sensor
+                self.zone = sensor.dest_sensor.zone
 
                 match self.responded_sensor.dest_sensor.location:
                     case Sensors.MID_GROUND.location:
@@ -172,8 +192,10 @@ class Walker(NodePath):
 
         if downward_hit := self.check_downward(next_pos):
             # Check whether the character will go outside or not.
-            if base.scene.check_sensors(current_pos, Sensors.HOLE.mask):
+            if base.scene.over_hole(current_pos) and \
+                    (sensor := base.scene.check_sensors(current_pos, Sensors.HOLE.mask)):
                 self.status = Status.MOVE
+                self.zone = sensor.zone
 
             hit_z = downward_hit.get_hit_pos().z
             next_pos.z = hit_z + 1.5
@@ -205,6 +227,7 @@ class Walker(NodePath):
         if self.actor.get_current_anim() != anim:
             self.actor.loop(anim)
 
+    @timed('walker:update')
     def update(self, dt, key_inputs):
         motion, direction = self.parse_args(key_inputs)
 